@@ -0,0 +1,511 @@
+''' Non-blocking Product Advertising API client.
+
+    AsyncProductAdvertisingAPI has the same item_search / item_lookup / browse_node_lookup calls as ProductAdvertisingAPI
+    but each returns an AsyncResult right away instead of blocking.  Requests go out on an asyncore event loop over a pool
+    of keep-alive connections, so hundreds can be in flight on a single thread:
+
+        api = AsyncProductAdvertisingAPI(aws_key, aws_secret, associate_tag)
+        results = [api.item_lookup(asin) for asin in asins]
+        api.run()                   # drive the loop until every request has finished
+        for r in results:
+            print r.get()
+
+    URL construction, signing and response conversion are ProductAdvertisingAPI's own.
+'''
+
+import asyncore
+from collections import deque
+import logging
+logger = logging.getLogger("amazon")
+import socket
+import sys
+import time
+import urllib2
+import urlparse
+from xml.etree import ElementTree as ET
+import zlib
+
+import paa
+
+
+class AsyncResult(object):
+    ''' the eventual value of a non-blocking call.  callbacks run on the event loop once it has finished. '''
+
+    def __init__(self):
+        self.finished = False
+        self.value = None
+        self.error = None
+        self.callbacks = []
+
+    def done(self):
+        return self.finished
+
+    def get(self):
+        ''' return the value, or raise the error.  only meaningful once done() '''
+        if not self.finished:
+            raise Exception("Result is not ready yet")
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def add_callback(self, callback):
+        ''' call callback(result) when finished, or right away if already finished '''
+        if self.finished:
+            callback(self)
+        else:
+            self.callbacks.append(callback)
+
+    def set_value(self, value):
+        self.value = value
+        self.finish()
+
+    def set_error(self, error):
+        self.error = error
+        self.finish()
+
+    def finish(self):
+        self.finished = True
+        callbacks = self.callbacks
+        self.callbacks = []
+        for callback in callbacks:
+            callback(self)
+
+    def then(self, func):
+        ''' return a new AsyncResult for func(value).  errors, from here or raised by func, are passed along. '''
+
+        chained = AsyncResult()
+
+        def on_done(result):
+            if result.error is not None:
+                chained.set_error(result.error)
+                return
+            try:
+                value = func(result.value)
+            except Exception, e:
+                chained.set_error(e)
+            else:
+                chained.set_value(value)
+
+        self.add_callback(on_done)
+        return chained
+
+
+def _dechunk(buf):
+    ''' decode a chunked transfer-encoding body, None if it isn't all there yet '''
+
+    chunks = []
+    pos = 0
+    while True:
+        eol = buf.find("\r\n", pos)
+        if eol < 0:
+            return None
+
+        size = int(buf[pos:eol].split(";")[0], 16)
+        if size == 0:
+            # last chunk, followed by (usually no) trailers and an empty line
+            if buf.find("\r\n", eol + 2) < 0:
+                return None
+            return "".join(chunks)
+
+        start = eol + 2
+        end = start + size
+        if len(buf) < end + 2:
+            return None
+
+        chunks.append(buf[start:end])
+        pos = end + 2
+
+
+class _HTTPConnection(asyncore.dispatcher):
+    ''' one keep-alive connection, making one GET at a time for an AsyncoreTransport '''
+
+    def __init__(self, transport, key):
+        asyncore.dispatcher.__init__(self, map=transport.map)
+
+        self.transport = transport
+        self.key = key
+        self.requests = 0
+
+        self.reset()
+
+    def start(self):
+        (scheme, host, port) = self.key
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect((host, port))
+
+    def reset(self):
+        self.url = None
+        self.result = None
+        self.started = None
+        self.outbuf = ""
+        self.inbuf = []
+        self.received = 0
+        self.tail = ""
+        self.status = None
+        self.headers = None
+        self.length = None
+        self.chunked = False
+        self.keep_alive = False
+
+    def busy(self):
+        return self.result is not None
+
+    def send_request(self, url, path, result):
+        self.reset()
+        self.url = url
+        self.result = result
+        self.started = time.time()
+        self.requests += 1
+
+        (scheme, host, port) = self.key
+        lines = [
+            "GET %s HTTP/1.1" % path,
+            "Host: %s" % host,
+            "Connection: keep-alive",
+        ]
+        if self.transport.gzip:
+            lines.append("Accept-Encoding: gzip")
+
+        self.outbuf = "\r\n".join(lines) + "\r\n\r\n"
+
+    def writable(self):
+        return not self.connected or len(self.outbuf) > 0
+
+    def handle_connect(self):
+        pass
+
+    def handle_write(self):
+        sent = self.send(self.outbuf)
+        self.outbuf = self.outbuf[sent:]
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if not data:
+            return
+
+        if self.result is None:
+            # nothing asked for.  the server shouldn't be talking:
+            self.close()
+            return
+
+        self.inbuf.append(data)
+        self.received += len(data)
+        self.tail = (self.tail + data)[-2:]
+        self.parse()
+
+    def parse(self):
+        if self.headers is None:
+            buf = "".join(self.inbuf)
+            end = buf.find("\r\n\r\n")
+            if end < 0:
+                self.inbuf = [buf]
+                return
+
+            lines = buf[:end].split("\r\n")
+            (version, status) = lines[0].split(" ", 2)[:2]
+            self.status = int(status)
+
+            self.headers = {}
+            for line in lines[1:]:
+                (name, value) = line.split(":", 1)
+                self.headers[name.strip().lower()] = value.strip()
+
+            connection = self.headers.get("connection", "").lower()
+            if version == "HTTP/1.1":
+                self.keep_alive = connection != "close"
+            else:
+                self.keep_alive = connection == "keep-alive"
+
+            if "content-length" in self.headers:
+                self.length = int(self.headers["content-length"])
+            elif self.headers.get("transfer-encoding", "").lower() == "chunked":
+                self.chunked = True
+            else:
+                # read until the server closes
+                self.keep_alive = False
+
+            rest = buf[end + 4:]
+            self.inbuf = [rest]
+            self.received = len(rest)
+
+        if self.length is not None:
+            if self.received >= self.length:
+                self.complete("".join(self.inbuf)[:self.length])
+
+        elif self.chunked:
+            if self.tail == "\r\n":
+                body = _dechunk("".join(self.inbuf))
+                if body is not None:
+                    self.complete(body)
+
+    def complete(self, body):
+        (url, result, status, headers) = (self.url, self.result, self.status, self.headers)
+        keep_alive = self.keep_alive
+        self.reset()
+
+        if keep_alive:
+            self.transport.checkin(self)
+        else:
+            self.close()
+            self.transport.released(self)
+
+        if headers.get("content-encoding") == "gzip":
+            try:
+                body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+            except zlib.error, e:
+                # (the body was framed right, so the connection is still good)
+                logger.error("Failed to decompress %s via async transport: %s" % (url, e))
+                result.set_error(urllib2.URLError(e))
+                return
+
+        if status != 200:
+            logger.error("Failed to get %s via async transport.  HTTP status code was %d" % (url, status))
+            result.set_error(urllib2.HTTPError(url, status, "HTTP status %d" % status, headers, None))
+        else:
+            result.set_value(body)
+
+    def fail(self, error, retry=True):
+        ''' drop this connection, failing the request on it.  (or retrying it, if this was a reused connection that never answered) '''
+
+        (url, result) = (self.url, self.result)
+        nothing_back = self.received == 0 and self.headers is None
+        reused = self.requests > 1
+        self.reset()
+
+        self.close()
+        self.transport.released(self)
+
+        if result is None:
+            # an idle connection went away, that's fine.
+            return
+
+        if retry and reused and nothing_back:
+            # the server probably dropped the idle connection on its end.  try again:
+            self.transport.submit(url, result)
+            return
+
+        logger.error("Failed to get %s via async transport: %s" % (url, error))
+        result.set_error(urllib2.URLError(error))
+
+    def handle_close(self):
+        if self.result is not None and self.headers is not None and self.length is None and not self.chunked:
+            # body was delimited by the connection closing
+            self.complete("".join(self.inbuf))
+            return
+
+        self.fail("connection closed")
+
+    def handle_error(self):
+        error = sys.exc_info()[1]
+        self.fail(error)
+
+
+class AsyncoreTransport(object):
+    ''' Non-blocking HTTP GETs over pooled keep-alive connections on an asyncore socket map.
+
+        max_connections - most connections open at once, across all hosts.  requests beyond that wait in a queue.
+        max_idle_per_host - most idle connections kept open for one host.
+        timeout - seconds before an in-flight request is given up on.
+        gzip - ask for gzip'ed responses and decompress them.
+
+        Any object with get(url) -> AsyncResult and run() can stand in for this one (e.x. to test against a stub server).
+    '''
+
+    def __init__(self, max_connections=100, max_idle_per_host=20, timeout=30.0, gzip=True):
+        self.max_connections = max_connections
+        self.max_idle_per_host = max_idle_per_host
+        self.timeout = timeout
+        self.gzip = gzip
+
+        self.map = {}
+        self.idle = {}          # (scheme, host, port) -> list of idle connections
+        self.open = 0           # connections open, idle or busy
+        self.busy = set()
+        self.waiting = deque()  # (url, result) waiting for a connection
+
+    def get(self, url):
+        ''' start a GET.  return an AsyncResult for the response body '''
+
+        result = AsyncResult()
+        self.submit(url, result)
+        return result
+
+    def submit(self, url, result):
+        parts = urlparse.urlsplit(url)
+        if parts.scheme != "http":
+            result.set_error(urllib2.URLError("Async transport only speaks http, not %s" % parts.scheme))
+            return
+
+        key = (parts.scheme, parts.hostname, parts.port or 80)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+
+        try:
+            conn = self.checkout(key)
+        except socket.error, e:
+            logger.error("Failed to get %s via async transport: %s" % (url, e))
+            result.set_error(urllib2.URLError(e))
+            return
+
+        if conn is None:
+            self.waiting.append((url, result))
+            return
+
+        conn.send_request(url, path, result)
+        self.busy.add(conn)
+
+    def checkout(self, key):
+        ''' an idle connection for this host, a new one if there's room, otherwise None '''
+
+        idle = self.idle.get(key)
+        while idle:
+            conn = idle.pop()
+            if conn.socket is not None:
+                return conn
+
+        if self.open >= self.max_connections:
+            return None
+
+        conn = _HTTPConnection(self, key)
+        try:
+            conn.start()
+        except socket.error:
+            conn.close()
+            raise
+
+        self.open += 1
+        return conn
+
+    def checkin(self, conn):
+        ''' a connection finished its request and can be reused '''
+
+        self.busy.discard(conn)
+
+        idle = self.idle.setdefault(conn.key, [])
+        if len(idle) < self.max_idle_per_host:
+            idle.append(conn)
+        else:
+            conn.close()
+            self.open -= 1
+
+        self.next_waiting()
+
+    def released(self, conn):
+        ''' a connection was closed '''
+
+        self.busy.discard(conn)
+
+        idle = self.idle.get(conn.key)
+        if idle and conn in idle:
+            idle.remove(conn)
+
+        self.open -= 1
+        self.next_waiting()
+
+    def next_waiting(self):
+        if self.waiting:
+            (url, result) = self.waiting.popleft()
+            self.submit(url, result)
+
+    def pending(self):
+        ''' number of requests not finished yet '''
+        return len(self.busy) + len(self.waiting)
+
+    def poll(self, timeout=0.05):
+        ''' one pass of the event loop '''
+
+        asyncore.loop(timeout=timeout, map=self.map, count=1)
+
+        now = time.time()
+        for conn in list(self.busy):
+            if conn.busy() and now - conn.started > self.timeout:
+                conn.fail(socket.timeout("timed out after %.1f seconds" % self.timeout), retry=False)
+
+    def run(self, timeout=0.05):
+        ''' drive the event loop until every request has finished '''
+
+        while self.pending():
+            self.poll(timeout)
+
+    def close(self):
+        ''' close every connection '''
+
+        for conn in self.map.values():
+            conn.close()
+        self.map.clear()
+        self.idle = {}
+        self.busy = set()
+        self.open = 0
+
+
+class AsyncProductAdvertisingAPI(object):
+    ''' Non-blocking counterpart of ProductAdvertisingAPI.  Every call returns an AsyncResult.
+
+        transport - AsyncoreTransport (or stand-in) to make requests on, a new AsyncoreTransport if None.
+        singleflight - singleflight.SingleFlight to coalesce identical calls in flight with, they all get the same 
+                       AsyncResult.  None to always make the request.
+        The rest of the arguments are ProductAdvertisingAPI's.
+    '''
+
+    def __init__(self, aws_key=None, aws_secret=None, associate_tag=None, locale="US", api_version="2011-08-01",
+                 printurl=False, transport=None, singleflight=None, host=None):
+
+        self.api = paa.ProductAdvertisingAPI(aws_key, aws_secret, associate_tag, locale=locale,
+                                             api_version=api_version, printurl=printurl, host=host)
+
+        if transport is None:
+            transport = AsyncoreTransport()
+        self.transport = transport
+        self.singleflight = singleflight
+
+    def fetch(self, operation, operation_params):
+        ''' start a request, return an AsyncResult for the raw response body '''
+
+        url = self.api.construct_url(operation, operation_params)
+
+        if self.api.printurl:
+            logger.warning(url)
+
+        return self.transport.get(url)
+
+    def fetchxml(self, operation, **operation_params):
+        ''' start a request, return an AsyncResult for the response document's root element '''
+
+        return self.fetch(operation, operation_params).then(ET.fromstring)
+
+    def browse_node_lookup(self, browse_node_id, response_group="BrowseNodeInfo"):
+        ''' BrowseNodeLookup, returns an AsyncResult for a BrowseNodeLookupResponse '''
+
+        return self.request("BrowseNodeLookup", dict(BrowseNodeId=str(browse_node_id), ResponseGroup=response_group),
+                            self.api.convert_browse_node_lookup_response)
+
+    def item_lookup(self, asin, response_group="Medium"):
+        ''' ItemLookup, returns an AsyncResult for an ItemLookupResponse '''
+
+        return self.request("ItemLookup", dict(ItemId=asin, Condition="All", ResponseGroup=response_group),
+                            self.api.convert_item_lookup_response)
+
+    def item_search(self, keywords=None, browse_node=None, search_index="All", response_group="Medium", title=None,
+                    page=None):
+        ''' ItemSearch, returns an AsyncResult for an ItemSearchResponse '''
+
+        params = self.api.item_search_params(keywords, browse_node, search_index, response_group, title, page)
+        return self.request("ItemSearch", params, self.api.convert_item_search_response)
+
+    def request(self, operation, operation_params, convert):
+        ''' an AsyncResult for convert(root element of the response), shared with an identical request in flight if 
+            there's a singleflight
+        '''
+
+        def start():
+            return self.fetchxml(operation, **operation_params).then(convert)
+
+        if self.singleflight is None:
+            return start()
+
+        return self.singleflight.do_async(self.api.request_key(operation, operation_params), start)
+
+    def run(self):
+        ''' drive the transport until every request has finished '''
+        self.transport.run()
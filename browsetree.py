@@ -0,0 +1,211 @@
+''' Crawl and keep a copy of (part of) the browse node tree.
+
+    BrowseNodeLookup only returns one node with its immediate children and ancestors, so mapping a category means one
+    lookup per node.  BrowseNodeTree expands the tree breadth first, a level at a time with several lookups in flight,
+    and remembers every node it has seen by id.  Saved to disk, a later crawl only looks up nodes whose children are
+    older than max_age:
+
+        tree = BrowseNodeTree.load(api, "books.tree")
+        tree.crawl([283155])
+        tree.save("books.tree")
+'''
+
+import codecs
+import logging
+logger = logging.getLogger("amazon")
+import os
+import tempfile
+import time
+
+import paa
+import workers
+
+
+class BrowseNodeTree(object):
+    ''' Memoized browse node tree.
+
+        api - ProductAdvertisingAPI to do lookups with.
+        max_workers - most lookups in flight at once.
+        max_age - seconds before a node's children are looked up again.
+    '''
+
+    def __init__(self, api, max_workers=4, max_age=7 * 24 * 3600):
+        self.api = api
+        self.max_workers = max_workers
+        self.max_age = max_age
+
+        self.nodes = {}         # node_id -> BrowseNode
+        self.children = {}      # node_id -> tuple of child node ids
+        self.parents = {}       # node_id -> tuple of immediate ancestor node ids
+        self.fetched = {}       # node_id -> time its children were looked up
+
+        self.lookups = 0
+        self.errors = 0
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def node(self, node_id):
+        return self.nodes.get(node_id)
+
+    def stale(self, node_id, now=None):
+        ''' True if node_id's children have never been looked up, or not for max_age '''
+
+        if now is None:
+            now = time.time()
+
+        fetched = self.fetched.get(node_id)
+        return fetched is None or now - fetched > self.max_age
+
+    def record(self, response, now=None):
+        ''' remember everything in a BrowseNodeLookupResponse '''
+
+        if now is None:
+            now = time.time()
+
+        node = response.node
+        self.nodes[node.node_id] = node
+
+        for n in response.children + response.ancestors:
+            # a node seen only as someone's child or ancestor doesn't have everything a lookup gives, so don't
+            # replace a looked up one with it:
+            if n.node_id not in self.fetched:
+                self.nodes[n.node_id] = n
+
+        self.children[node.node_id] = tuple([n.node_id for n in response.children])
+        self.parents[node.node_id] = tuple([n.node_id for n in response.ancestors])
+        self.fetched[node.node_id] = now
+
+    def crawl(self, root_ids, max_depth=None):
+        ''' Expand the tree under root_ids breadth first, down to max_depth levels below them (None for all the way).
+
+            Only stale nodes are looked up, fresh ones are expanded from what's already known.  Returns the number of
+            lookups made.
+        '''
+
+        lookups = 0
+        seen = set()
+        level = [int(node_id) for node_id in root_ids]
+        depth = 0
+
+        while level:
+            level = [node_id for node_id in level if node_id not in seen]
+            seen.update(level)
+
+            now = time.time()
+            stale = [node_id for node_id in level if self.stale(node_id, now)]
+
+            if stale:
+                logger.info("Browse node tree: looking up %d of %d nodes at depth %d" % (len(stale), len(level), depth))
+
+                for result in workers.pmap(self.api.browse_node_lookup, stale, max_workers=self.max_workers):
+                    lookups += 1
+                    if result.ok():
+                        self.record(result.value, now)
+                    else:
+                        # leave it stale, the next crawl will try again.
+                        self.errors += 1
+
+            if max_depth is not None and depth >= max_depth:
+                break
+
+            next_level = []
+            for node_id in level:
+                next_level.extend(self.children.get(node_id, ()))
+
+            level = next_level
+            depth += 1
+
+        self.lookups += lookups
+        return lookups
+
+    def walk(self, node_id, depth=0):
+        ''' yield (depth, BrowseNode) for node_id and everything known below it, depth first '''
+
+        node = self.nodes.get(node_id)
+        if node is None:
+            return
+
+        yield (depth, node)
+        for child_id in self.children.get(node_id, ()):
+            for item in self.walk(child_id, depth + 1):
+                yield item
+
+    def dump(self, node_id):
+        ''' print the known subtree under node_id '''
+
+        for (depth, node) in self.walk(node_id):
+            print "%s%s (%d)" % ("  " * depth, (node.name or u"").encode("utf-8"), node.node_id)
+
+    # The on-disk index is one utf-8 line per node, tab separated:
+    #
+    #   node_id  name  category_root (1/0/-)  fetched time (or -)  child ids  ancestor ids
+    #
+    # with the id lists comma separated.
+
+    def save(self, path):
+        ''' write the tree to path.  (written to a temp file and renamed into place) '''
+
+        directory = os.path.dirname(os.path.abspath(path))
+        (fd, tmp) = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        os.close(fd)
+
+        f = codecs.open(tmp, "w", "utf-8")
+        try:
+            for (node_id, node) in self.nodes.iteritems():
+                if node.category_root is None:
+                    root = "-"
+                else:
+                    root = str(int(node.category_root))
+
+                fetched = self.fetched.get(node_id)
+                if fetched is None:
+                    fetched = "-"
+                else:
+                    fetched = "%d" % fetched
+
+                name = (node.name or u"").replace(u"\t", u" ").replace(u"\n", u" ")
+
+                f.write(u"%d\t%s\t%s\t%s\t%s\t%s\n" % (node_id, name, root, fetched,
+                        ",".join([str(c) for c in self.children.get(node_id, ())]),
+                        ",".join([str(p) for p in self.parents.get(node_id, ())])))
+        finally:
+            f.close()
+
+        os.rename(tmp, path)
+
+    @classmethod
+    def load(cls, api, path, **kwargs):
+        ''' a BrowseNodeTree read from path, or an empty one if there's nothing there yet.  kwargs are passed to __init__ '''
+
+        tree = cls(api, **kwargs)
+        if not os.path.exists(path):
+            return tree
+
+        def ids(s):
+            if not s:
+                return ()
+            return tuple([int(i) for i in s.split(",")])
+
+        # (as bytes: codecs' line iteration also splits on \r, \x85, \u2028 and \u2029, which names can have)
+        f = open(path, "rb")
+        try:
+            for line in f:
+                line = line.rstrip("\n").decode("utf-8")
+                (node_id, name, root, fetched, children, parents) = line.split(u"\t")
+
+                node = paa.BrowseNode()
+                node.node_id = int(node_id)
+                node.name = name
+                if root != "-":
+                    node.category_root = bool(int(root))
+                tree.nodes[node.node_id] = node
+
+                if fetched != "-":
+                    tree.fetched[node.node_id] = float(fetched)
+                    tree.children[node.node_id] = ids(children)
+                    tree.parents[node.node_id] = ids(parents)
+        finally:
+            f.close()
+
+        return tree
@@ -0,0 +1,273 @@
+''' Response caches for ProductAdvertisingAPI.fetch.
+
+    Entries are raw response documents keyed on the canonical request (see ProductAdvertisingAPI.request_key), so the
+    same request made again inside its operation's ttl never hits the network.  Both caches evict least recently used
+    entries once there are more than max_entries of them or they add up to more than max_bytes.
+
+        api = paa.ProductAdvertisingAPI(cache=cache.MemoryCache(ttls={"ItemSearch": 600}))
+'''
+
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResponseCache(object):
+    ''' TTL, LRU and hit/miss bookkeeping shared by the cache backends.
+
+        ttls - seconds to keep responses, by operation name.  a ttl of 0 means that operation isn't cached.
+        default_ttl - seconds to keep responses for operations not in ttls.
+        max_entries - most responses kept.
+        max_bytes - most response bytes kept.
+    '''
+
+    default_ttls = {
+        "ItemSearch": 3600,
+        "ItemLookup": 3600,
+        "BrowseNodeLookup": 24 * 3600,   # the browse node tree hardly ever changes
+    }
+
+    def __init__(self, ttls=None, default_ttl=3600, max_entries=1000, max_bytes=64 * 1024 * 1024):
+        self.ttls = dict(self.default_ttls)
+        if ttls:
+            self.ttls.update(ttls)
+        self.default_ttl = default_ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def ttl(self, operation):
+        return self.ttls.get(operation, self.default_ttl)
+
+    def get(self, key):
+        ''' return the cached response for key, or None if there isn't a fresh one '''
+
+        body = self.load(key, time.time())
+
+        self.lock.acquire()
+        try:
+            if body is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        finally:
+            self.lock.release()
+
+        return body
+
+    def put(self, key, operation, body):
+        ''' cache a response, unless its operation has a ttl of 0 '''
+
+        ttl = self.ttl(operation)
+        if ttl <= 0:
+            return
+
+        self.store(key, time.time() + ttl, body)
+
+    def stats(self):
+        ''' hit/miss counters as a dict '''
+
+        lookups = self.hits + self.misses
+        if lookups:
+            hit_rate = float(self.hits) / lookups
+        else:
+            hit_rate = 0.0
+
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": hit_rate,
+            "evictions": self.evictions,
+        }
+
+    def load(self, key, now):
+        ''' backend: return the body stored for key if it hasn't expired, else None '''
+        raise NotImplementedError()
+
+    def store(self, key, expires, body):
+        ''' backend: store body for key until expires (epoch seconds), evicting as needed '''
+        raise NotImplementedError()
+
+    def clear(self):
+        ''' backend: drop everything '''
+        raise NotImplementedError()
+
+
+class MemoryCache(ResponseCache):
+    ''' in-process cache.  (not shared between workers) '''
+
+    def __init__(self, **kwargs):
+        ResponseCache.__init__(self, **kwargs)
+        self.entries = OrderedDict()    # key -> (expires, body), least recently used first
+        self.size = 0
+
+    def load(self, key, now):
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+
+            (expires, body) = entry
+            if expires <= now:
+                self.size -= len(body)
+                return None
+
+            # move to the most recently used end
+            self.entries[key] = entry
+            return body
+        finally:
+            self.lock.release()
+
+    def store(self, key, expires, body):
+        self.lock.acquire()
+        try:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[1])
+
+            self.entries[key] = (expires, body)
+            self.size += len(body)
+
+            while self.entries and (len(self.entries) > self.max_entries or self.size > self.max_bytes):
+                (k, (e, b)) = self.entries.popitem(last=False)
+                self.size -= len(b)
+                self.evictions += 1
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries = OrderedDict()
+            self.size = 0
+        finally:
+            self.lock.release()
+
+
+class DiskCache(ResponseCache):
+    ''' cache in a directory, so several worker processes can share it.
+
+        Each entry is one file: its expiry time on the first line, then the response.  Files are written to a temp
+        file and renamed into place so readers never see half an entry.  A file's mtime is bumped when it is read,
+        which is what the LRU eviction goes by.  Eviction scans the directory every evict_interval puts.
+    '''
+
+    suffix = ".xml"
+
+    def __init__(self, directory, evict_interval=100, **kwargs):
+        ResponseCache.__init__(self, **kwargs)
+        self.directory = directory
+        self.evict_interval = evict_interval
+        self.puts = 0
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key).hexdigest() + self.suffix)
+
+    def load(self, key, now):
+        path = self.path(key)
+        try:
+            f = open(path, "rb")
+        except IOError:
+            return None
+
+        try:
+            expires = float(f.readline())
+            if expires <= now:
+                return None
+            body = f.read()
+        finally:
+            f.close()
+
+        try:
+            os.utime(path, None)
+        except OSError:
+            # evicted by another worker in the meantime
+            pass
+
+        return body
+
+    def store(self, key, expires, body):
+        (fd, tmp) = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        f = os.fdopen(fd, "wb")
+        try:
+            f.write("%f\n" % expires)
+            f.write(body)
+        finally:
+            f.close()
+
+        os.rename(tmp, self.path(key))
+
+        self.lock.acquire()
+        try:
+            self.puts += 1
+            evict = self.puts % self.evict_interval == 0
+        finally:
+            self.lock.release()
+
+        if evict:
+            self.evict()
+
+    def evict(self):
+        ''' remove expired entries, then the least recently used ones until the cache is under its limits '''
+
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.suffix):
+                continue
+
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+
+        entries.sort()
+        size = sum([e[1] for e in entries])
+
+        evicted = 0
+        for (mtime, nbytes, path) in entries:
+            if len(entries) - evicted <= self.max_entries and size <= self.max_bytes and not self.expired(path, now):
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            evicted += 1
+            size -= nbytes
+
+        self.lock.acquire()
+        try:
+            self.evictions += evicted
+        finally:
+            self.lock.release()
+
+    def expired(self, path, now):
+        try:
+            f = open(path, "rb")
+        except IOError:
+            return True
+        try:
+            return float(f.readline()) <= now
+        finally:
+            f.close()
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith(self.suffix):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+#
+# Stream item search results for whole browse nodes to a file: NDJSON, CSV, or a compact columnar format.
+#
+# Products are written as each result page is parsed, so memory stays at a page (or a columnar row group) whatever
+# the size of the export.  With a checkpoint file, an interrupted export picks up after the last checkpointed page:
+#
+# ex: python export.py -n 283155 -n 17 -i Books -f csv -o books.csv -c books.checkpoint
+#
+
+import array
+import csv
+import json
+import logging
+logger = logging.getLogger("amazon")
+from optparse import OptionParser
+import os
+import struct
+import sys
+import tempfile
+
+import paa
+
+FIELDS = paa.Product.__slots__
+LIST_FIELDS = ("actors", "artists")
+
+
+def product_dict(product):
+    ''' the product's fields as a dict, for json '''
+    return dict([(field, getattr(product, field)) for field in FIELDS])
+
+
+class NDJSONWriter(object):
+    ''' a json object per product per line '''
+
+    def __init__(self, f, resume=False):
+        self.f = f
+
+    def write(self, product):
+        record = product_dict(product)
+        for field in LIST_FIELDS:
+            record[field] = list(record[field])
+        self.f.write(json.dumps(record, separators=(",", ":")))
+        self.f.write("\n")
+
+    def flush(self):
+        pass
+
+
+class CSVWriter(object):
+    ''' utf-8 csv with a header row.  actors and artists are joined with "|" '''
+
+    def __init__(self, f, resume=False):
+        self.writer = csv.writer(f)
+        if not resume:
+            self.writer.writerow(FIELDS)
+
+    def write(self, product):
+        row = []
+        for field in FIELDS:
+            value = getattr(product, field)
+            if field in LIST_FIELDS:
+                value = u"|".join(value)
+            if value is None:
+                value = ""
+            elif isinstance(value, unicode):
+                value = value.encode("utf-8")
+            row.append(value)
+        self.writer.writerow(row)
+
+    def flush(self):
+        pass
+
+
+# The columnar format is a magic line followed by row groups.  A row group is:
+#
+#   "ROWS", row count (uint32), then for each field in FIELDS order: byte length of the column (uint32) and the column.
+#
+# so a reader can skip the columns it doesn't want.  lowest_new_price is little endian doubles, NaN for none.
+# sales_rank is little endian int32s, -1 for none.  Every other column is a length (int32, -1 for None) and utf-8
+# bytes per row, actors and artists joined with "\x1f".  Integers are little endian.
+
+COLUMNAR_MAGIC = "PAACOLUMNS1\n"
+LIST_SEPARATOR = u"\x1f"
+
+
+def _little_endian(a):
+    if sys.byteorder == "big":
+        a.byteswap()
+    return a
+
+
+class ColumnarWriter(object):
+    ''' products buffered into a ProductBatch, written out a row group at a time '''
+
+    def __init__(self, f, resume=False, row_group_size=1000):
+        self.f = f
+        self.row_group_size = row_group_size
+        self.batch = paa.ProductBatch()
+        if not resume:
+            f.write(COLUMNAR_MAGIC)
+
+    def write(self, product):
+        self.batch.append(product)
+        if len(self.batch) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        ''' write out the buffered rows as a row group '''
+
+        batch = self.batch
+        if not len(batch):
+            return
+
+        columns = []
+        for field in FIELDS:
+            if field == "lowest_new_price":
+                column = _little_endian(array.array("d", batch.lowest_new_price)).tostring()
+            elif field == "sales_rank":
+                column = _little_endian(array.array("i", batch.sales_rank)).tostring()
+            else:
+                parts = []
+                for value in getattr(batch, field):
+                    if field in LIST_FIELDS:
+                        value = LIST_SEPARATOR.join(value)
+                    if value is None:
+                        parts.append(struct.pack("<i", -1))
+                    else:
+                        value = value.encode("utf-8")
+                        parts.append(struct.pack("<i", len(value)))
+                        parts.append(value)
+                column = "".join(parts)
+            columns.append(struct.pack("<I", len(column)) + column)
+
+        self.f.write("ROWS" + struct.pack("<I", len(batch)))
+        self.f.write("".join(columns))
+
+        self.batch = paa.ProductBatch()
+
+
+def read_columnar(path, fields=FIELDS):
+    ''' yield a ProductBatch per row group of a columnar export, with only fields filled in (the rest are skipped) '''
+
+    f = open(path, "rb")
+    try:
+        if f.read(len(COLUMNAR_MAGIC)) != COLUMNAR_MAGIC:
+            raise Exception("%s is not a columnar export" % path)
+
+        while True:
+            header = f.read(8)
+            if not header:
+                return
+            if len(header) < 8 or header[:4] != "ROWS":
+                raise Exception("Corrupt row group in %s" % path)
+            (rows,) = struct.unpack("<I", header[4:])
+
+            batch = paa.ProductBatch()
+            for field in FIELDS:
+                (length,) = struct.unpack("<I", f.read(4))
+                if field not in fields:
+                    f.seek(length, os.SEEK_CUR)
+                    continue
+
+                column = f.read(length)
+                if field == "lowest_new_price":
+                    batch.lowest_new_price = _little_endian(array.array("d", column))
+                elif field == "sales_rank":
+                    batch.sales_rank = array.array("l", _little_endian(array.array("i", column)))
+                else:
+                    values = []
+                    pos = 0
+                    for i in xrange(rows):
+                        (n,) = struct.unpack("<i", column[pos:pos + 4])
+                        pos += 4
+                        if n < 0:
+                            value = None
+                        else:
+                            value = column[pos:pos + n].decode("utf-8")
+                            pos += n
+                        if field in LIST_FIELDS:
+                            value = value and tuple(value.split(LIST_SEPARATOR)) or ()
+                        values.append(value)
+                    setattr(batch, field, values)
+
+            # columns that were skipped are left empty, keep them the right length:
+            for field in paa.ProductBatch.object_columns:
+                if field not in fields:
+                    setattr(batch, field, [None] * rows)
+            if "lowest_new_price" not in fields:
+                batch.lowest_new_price = array.array("d", [paa.NAN] * rows)
+            if "sales_rank" not in fields:
+                batch.sales_rank = array.array("l", [-1] * rows)
+
+            yield batch
+    finally:
+        f.close()
+
+
+WRITERS = {
+    "ndjson": NDJSONWriter,
+    "csv": CSVWriter,
+    "columnar": ColumnarWriter,
+}
+
+
+def load_checkpoint(path):
+    ''' the saved export state at path, None if there isn't one '''
+
+    if path is None or not os.path.exists(path):
+        return None
+
+    f = open(path)
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+
+def save_checkpoint(path, state):
+    ''' write state to path.  (written to a temp file and renamed into place) '''
+
+    directory = os.path.dirname(os.path.abspath(path))
+    (fd, tmp) = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    f = os.fdopen(fd, "w")
+    try:
+        json.dump(state, f)
+    finally:
+        f.close()
+    os.rename(tmp, path)
+
+
+def export(api, nodes, path, format="ndjson", checkpoint_path=None, checkpoint_every=5, max_pages=10, **search_params):
+    ''' Write every item search result for each browse node in nodes to path, returning the number of products written.
+
+        format - "ndjson", "csv" or "columnar".
+        checkpoint_path - where to keep the export's progress.  If there's a checkpoint there from an interrupted export
+                          of the same nodes to the same file, the file is cut back to the checkpoint and the export
+                          carries on from the page after it.  The checkpoint is removed when the export finishes.
+        checkpoint_every - pages between checkpoints.
+        max_pages - most result pages fetched per node.  (ItemSearch won't return pages past 10 anyway)
+        search_params - passed to item_search.  (search_index, keywords, response_group...)
+    '''
+
+    nodes = [str(node) for node in nodes]
+
+    state = load_checkpoint(checkpoint_path)
+    if state is not None:
+        if state["path"] != os.path.abspath(path) or state["format"] != format or state["nodes"] != nodes:
+            raise Exception("Checkpoint %s is for a different export" % checkpoint_path)
+
+        if state["node"] >= len(nodes):
+            # the export finished, but the checkpoint wasn't removed
+            logger.info("Export to %s already finished (%d products written)" % (path, state["rows"]))
+            os.remove(checkpoint_path)
+            return state["rows"]
+
+        f = open(path, "r+b")
+        f.truncate(state["offset"])
+        f.seek(state["offset"])
+        logger.info("Resuming export to %s at node %s page %d (%d products written)" %
+                    (path, nodes[state["node"]], state["page"] + 1, state["rows"]))
+    else:
+        state = {"path": os.path.abspath(path), "format": format, "nodes": nodes, "node": 0, "page": 0, "offset": 0,
+                 "rows": 0}
+        f = open(path, "wb")
+
+    writer = WRITERS[format](f, resume=state["offset"] > 0)
+
+    def checkpoint(node, page):
+        writer.flush()
+        f.flush()
+        os.fsync(f.fileno())
+        state.update(node=node, page=page, offset=f.tell())
+        if checkpoint_path is not None:
+            save_checkpoint(checkpoint_path, state)
+
+    try:
+        for node_index in xrange(state["node"], len(nodes)):
+            page = 1
+            if node_index == state["node"]:
+                page = state["page"] + 1
+
+            num_pages = max_pages
+            while page <= min(num_pages, max_pages):
+                # streamed, so only one Item is held at a time:
+                response = api.item_search(browse_node=nodes[node_index], page=page, stream=True, **search_params)
+                num_pages = response.num_pages
+                for product in response.products:
+                    writer.write(product)
+                    state["rows"] += 1
+
+                if page % checkpoint_every == 0:
+                    checkpoint(node_index, page)
+                page += 1
+
+            # the next node starts from its first page:
+            checkpoint(node_index + 1, 0)
+
+    finally:
+        f.close()
+
+    if checkpoint_path is not None and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    return state["rows"]
+
+
+if __name__=='__main__':
+    logging.basicConfig()
+    logger.setLevel(logging.INFO)
+
+    parser = OptionParser(usage="%prog [options] -n NODE [-n NODE...]")
+    parser.add_option("-n", "--node", dest="nodes", help="Browse node to export.  May be repeated", metavar="NODE",
+                      default=[], action="append")
+    parser.add_option("-i", "--search-index", dest="search_index", help="Search index the nodes are in", metavar="INDEX",
+                      default="Books")
+    parser.add_option("-k", "--keywords", dest="keywords", help="Only export results matching KEYWORDS", metavar="KEYWORDS")
+    parser.add_option("-f", "--format", dest="format", help="Output format (ndjson, csv, columnar)", metavar="FORMAT",
+                      default="ndjson", choices=sorted(WRITERS.keys()))
+    parser.add_option("-o", "--output", dest="output", help="File to write to", metavar="FILE")
+    parser.add_option("-c", "--checkpoint", dest="checkpoint", help="Checkpoint file to resume from and save progress to",
+                      metavar="FILE")
+    parser.add_option("-p", "--max-pages", dest="max_pages", help="Most result pages per node", metavar="PAGES",
+                      default=10, type="int")
+    (options, args) = parser.parse_args()
+
+    if not options.nodes or not options.output:
+        parser.error("at least one --node and an --output are required")
+
+    api = paa.ProductAdvertisingAPI(paa.AWS_KEY, paa.AWS_SECRET)
+    rows = export(api, options.nodes, options.output, options.format, checkpoint_path=options.checkpoint,
+                  max_pages=options.max_pages, search_index=options.search_index, keywords=options.keywords)
+    print "%d products written to %s" % (rows, options.output)
@@ -0,0 +1,149 @@
+''' Per-operation timing and size metrics for ProductAdvertisingAPI.
+
+    The api records, per operation (ItemSearch, ItemLookup, ...):
+
+        sign, network, parse, convert - seconds spent in each phase of a request.  (network is up to the response
+                                        headers, the body is read off the connection while it's parsed)
+        bytes - response size
+        items - products converted
+
+    by calling metrics.record(operation, name, value).  The default NullMetrics has enabled = False, and the api
+    doesn't even read the clock when metrics aren't enabled.  MemoryMetrics keeps samples and reports percentiles:
+
+        m = metrics.MemoryMetrics()
+        api = paa.ProductAdvertisingAPI(metrics=m)
+        ...
+        print "\n".join(m.dump())
+'''
+
+import random
+import threading
+
+PHASES = ("sign", "network", "parse", "convert")
+
+
+class NullMetrics(object):
+    ''' records nothing '''
+
+    enabled = False
+
+    def record(self, operation, name, value):
+        pass
+
+
+class Histogram(object):
+    ''' count, sum and max of every value, plus a uniform sample of up to max_samples of them for percentiles '''
+
+    __slots__ = ("count", "total", "max", "samples", "max_samples")
+
+    def __init__(self, max_samples):
+        self.count = 0
+        self.total = 0.0
+        self.max = None
+        self.samples = []
+        self.max_samples = max_samples
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.max is None or value > self.max:
+            self.max = value
+
+        if len(self.samples) < self.max_samples:
+            self.samples.append(value)
+        else:
+            # reservoir sampling, every value so far has the same chance of being kept
+            i = random.randint(0, self.count - 1)
+            if i < self.max_samples:
+                self.samples[i] = value
+
+    def percentile(self, p):
+        ''' the pth percentile (0-100) of the sampled values '''
+
+        if not self.samples:
+            return None
+
+        ordered = sorted(self.samples)
+        i = int(round((p / 100.0) * (len(ordered) - 1)))
+        return ordered[i]
+
+
+class MemoryMetrics(object):
+    ''' keeps a Histogram per (operation, name) in memory '''
+
+    enabled = True
+
+    def __init__(self, max_samples=10000):
+        self.max_samples = max_samples
+        self.lock = threading.Lock()
+        self.histograms = {}    # (operation, name) -> Histogram
+
+    def record(self, operation, name, value):
+        key = (operation, name)
+
+        self.lock.acquire()
+        try:
+            h = self.histograms.get(key)
+            if h is None:
+                h = Histogram(self.max_samples)
+                self.histograms[key] = h
+            h.add(value)
+        finally:
+            self.lock.release()
+
+    def histogram(self, operation, name):
+        return self.histograms.get((operation, name))
+
+    def summary(self):
+        ''' {(operation, name): {"count", "total", "max", "p50", "p95", "p99"}} '''
+
+        self.lock.acquire()
+        try:
+            summary = {}
+            for (key, h) in self.histograms.items():
+                summary[key] = {
+                    "count": h.count,
+                    "total": h.total,
+                    "max": h.max,
+                    "p50": h.percentile(50),
+                    "p95": h.percentile(95),
+                    "p99": h.percentile(99),
+                }
+            return summary
+        finally:
+            self.lock.release()
+
+    def dump(self):
+        ''' the summary as printable lines, phases in milliseconds '''
+
+        lines = []
+        summary = self.summary()
+
+        def order(key):
+            (operation, name) = key
+            if name in PHASES:
+                return (operation, PHASES.index(name), name)
+            return (operation, len(PHASES), name)
+
+        for key in sorted(summary.keys(), key=order):
+            (operation, name) = key
+            s = summary[key]
+
+            if name in PHASES:
+                fmt = "%.1fms"
+                scale = 1000.0
+            else:
+                fmt = "%d"
+                scale = 1
+
+            values = " ".join(["%s=%s" % (p, fmt % (s[p] * scale)) for p in ("p50", "p95", "p99", "max")])
+            lines.append("%-18s %-8s n=%-6d %s" % (operation, name, s["count"], values))
+
+        return lines
+
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.histograms = {}
+        finally:
+            self.lock.release()
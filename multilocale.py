@@ -0,0 +1,135 @@
+''' The same lookups in several Amazon marketplaces at once.
+
+    Each locale gets its own ProductAdvertisingAPI (so its own endpoint host, request signer and connection pool), and
+    lookup_across_locales sends every locale's requests at the same time, so a call takes about as long as the slowest
+    locale rather than all of them one after another:
+
+        api = MultiLocaleAPI(aws_key, aws_secret, associate_tags={"US": "mytag-20", "UK": "mytag-21"})
+        matrix = api.lookup_across_locales(["B002HJJ2VA", "0307295676"], ["US", "UK", "DE"])
+        matrix.dump()
+
+    Prices are in each marketplace's own currency.
+'''
+
+import logging
+logger = logging.getLogger("amazon")
+
+import net
+import paa
+import workers
+
+
+class PriceMatrix(object):
+    ''' lowest new price for each (ASIN, locale) looked up '''
+
+    def __init__(self, asins, locales):
+        self.asins = list(asins)
+        self.locales = list(locales)
+        self.products = {}  # (asin, locale) -> Product
+        self.errors = {}    # (asin, locale) -> exception, for lookups that failed
+
+    def price(self, asin, locale):
+        ''' the lowest new price of asin in locale, None if it has none or the lookup failed '''
+
+        product = self.products.get((asin, locale))
+        if product is None:
+            return None
+        return product.lowest_new_price
+
+    def row(self, asin):
+        ''' asin's prices, in the same order as locales '''
+        return [self.price(asin, locale) for locale in self.locales]
+
+    def rows(self):
+        ''' yield (asin, row) for every asin '''
+
+        for asin in self.asins:
+            yield (asin, self.row(asin))
+
+    def dump(self):
+        ''' print the matrix, an ASIN per line '''
+
+        print "%-12s %s" % ("ASIN", " ".join(["%10s" % locale for locale in self.locales]))
+        for (asin, row) in self.rows():
+            cells = []
+            for (locale, price) in zip(self.locales, row):
+                if price is not None:
+                    cells.append("%10.2f" % price)
+                elif (asin, locale) in self.errors:
+                    cells.append("%10s" % "error")
+                else:
+                    cells.append("%10s" % "-")
+            print "%-12s %s" % (asin, " ".join(cells))
+
+
+class MultiLocaleAPI(object):
+    ''' A ProductAdvertisingAPI per locale, made on first use.
+
+        associate_tags - locale -> associate tag.  (tags are per marketplace)  locales without one get associate_tag.
+        pools - locale -> net.ConnectionPool.  locales without one get a pool of their own.
+        kwargs - anything else for each ProductAdvertisingAPI (cache, scheduler, metrics, ...)
+    '''
+
+    def __init__(self, aws_key=None, aws_secret=None, associate_tag=None, associate_tags=None, pools=None, **kwargs):
+        self.aws_key = aws_key
+        self.aws_secret = aws_secret
+        self.associate_tag = associate_tag
+        self.associate_tags = associate_tags or {}
+        self.pools = dict(pools or {})
+        self.kwargs = kwargs
+
+        self.clients = {}   # locale -> ProductAdvertisingAPI
+
+    def client(self, locale):
+        ''' the ProductAdvertisingAPI for locale '''
+
+        api = self.clients.get(locale)
+        if api is None:
+            pool = self.pools.get(locale)
+            if pool is None:
+                pool = net.ConnectionPool()
+                self.pools[locale] = pool
+
+            api = paa.ProductAdvertisingAPI(self.aws_key, self.aws_secret, self.associate_tags.get(locale, self.associate_tag),
+                                            locale=locale, pool=pool, **self.kwargs)
+            self.clients[locale] = api
+
+        return api
+
+    def lookup_across_locales(self, asins, locales, response_group="Medium", max_workers=16):
+        ''' Look up asins in every one of locales, returning a PriceMatrix.
+
+            Every locale's ItemLookup requests (paa.MAX_LOOKUP_ITEMS ASINs each) go out in parallel, at most max_workers at
+            a time.  A failed lookup is recorded in the matrix's errors rather than raised.
+        '''
+
+        asins = list(asins)
+        locales = list(locales)
+        matrix = PriceMatrix(asins, locales)
+
+        # make the clients up front, not racing in the worker threads:
+        clients = dict([(locale, self.client(locale)) for locale in locales])
+
+        chunks = [asins[i:i + paa.MAX_LOOKUP_ITEMS] for i in xrange(0, len(asins), paa.MAX_LOOKUP_ITEMS)]
+        tasks = [(locale, chunk) for locale in locales for chunk in chunks]
+
+        def lookup(task):
+            (locale, chunk) = task
+            return clients[locale].item_lookup_batch(chunk, response_group)
+
+        for task_result in workers.pmap(lookup, tasks, max_workers=max_workers):
+            (locale, chunk) = task_result.arg
+            if not task_result.ok():
+                # item_lookup_batch already turns request failures into per ASIN errors, this is something worse
+                logger.error("Lookup in %s failed: %s" % (locale, task_result.error))
+                for asin in chunk:
+                    matrix.errors[(asin, locale)] = task_result.error
+                continue
+
+            for result in task_result.value:
+                if result.ok():
+                    matrix.products[(result.arg, locale)] = result.value.product
+                else:
+                    matrix.errors[(result.arg, locale)] = result.error
+
+        return matrix
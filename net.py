@@ -1,8 +1,18 @@
+from collections import deque
 from cStringIO import StringIO 
+import httplib
 import logging
 logger = logging.getLogger("amazon")
+import Queue
+import random
+import socket
+import sys
+import threading
+import time
 import urllib
 import urllib2
+import urlparse
+import zlib
 
 ''' App engine is wonky with respect to using urllib2.  Sometimes perfectly valid URLs raise a 404 if urllib2 is used.  So.  Try to detect if we're on app engine and use its urlfetch api directly if we are...
 
@@ -16,13 +26,18 @@ except ImportError:
     app_engine = False
     
     
-def app_engine_get(url):
+CONNECT_TIMEOUT = 10.0  # seconds to wait for a connection to amazon
+READ_TIMEOUT = 30.0     # seconds to wait on a connection for (more of) a response
+
+
+def app_engine_get(url, deadline=READ_TIMEOUT):
     ''' do a HTTP get using app engine's urlfetch interface directly '''
     
     try:
-        response = urlfetch.fetch(url, method="GET", deadline=10) # 10 second deadline
+        response = urlfetch.fetch(url, method="GET", deadline=deadline)
         if not response.status_code == 200:
-            raise Exception("Failed to get %s via urlfetch.  HTTP status code was %d" % (url, response.status_code))
+            raise urllib2.HTTPError(url, response.status_code, "Failed to get %s via urlfetch" % url, None,
+                                    StringIO(response.content))
             
         return response.content
         
@@ -31,28 +46,780 @@ def app_engine_get(url):
         raise
         
 
-def standard_lib_get(url):
-    ''' do an HTTP get using python's urllib2 package '''
+CHUNK_SIZE = 64 * 1024              # bytes read off the socket (or inflated) at a time when streaming a response
+MAX_BODY_SIZE = 16 * 1024 * 1024    # a sane cap for PA-API responses, which are tens of KB
 
-    try:
-        result = urllib2.urlopen(url)
-        return result.read()
 
-    except urllib2.URLError, e:
-        logger.error("Failed to get %s via urllib2" % url)
-        raise
+class ResponseTooLarge(urllib2.URLError):
+    ''' the response body was bigger than the max_body_size asked for '''
+    pass
+
+
+class PoolTimeout(urllib2.URLError):
+    ''' no connection to the host came free in time, the request wasn't sent '''
+    pass
+
+
+class ResponseStream(object):
+    ''' File-like body of a pooled response, read off the socket (and gunzipped) a chunk at a time as it's read.
+    
+        Nothing but the current chunk is held, so the parser reading it is the only thing holding the document.  Once 
+        the body has been read to the end the connection goes back to the pool.  close() before then closes it instead.
+        read() may return less than asked for, like a socket, but only returns "" at the end of the body.
+    '''
+    
+    def __init__(self, pool, key, conn, response, url, max_body_size=None, chunk_size=CHUNK_SIZE):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.url = url
+        self.max_body_size = max_body_size
+        self.chunk_size = chunk_size
+        
+        if response.getheader("content-encoding") == "gzip":
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self.decompressor = None
+            
+        self.buffer = ""    # decoded bytes not returned by read() yet
+        self.size = 0       # decoded bytes so far
+        self.done = False
+        
+    def read(self, n=-1):
+        if n is None or n < 0:
+            chunks = [self.buffer]
+            self.buffer = ""
+            while not self.done:
+                chunks.append(self.fill())
+            return "".join(chunks)
+            
+        while not self.buffer and not self.done:
+            self.buffer = self.fill()
+            
+        data = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return data
+        
+    def fill(self):
+        ''' return the next decoded chunk of the body, "" at the end of it '''
+        
+        d = self.decompressor
+        try:
+            if d is not None and d.unconsumed_tail:
+                # still inflating the last chunk read, don't read more until it's used up
+                raw = d.unconsumed_tail
+            else:
+                raw = self.response.read(self.chunk_size)
+        except (httplib.HTTPException, socket.error), e:
+            self.abort()
+            logger.error("Failed to read %s via connection pool" % self.url)
+            raise urllib2.URLError(e)
+            
+        if d is None:
+            data = raw
+        elif raw:
+            # inflate no more than a chunk at a time, so a small compressed body can't blow up in memory all at once
+            data = d.decompress(raw, self.chunk_size)
+        else:
+            data = d.flush()
+            
+        if not raw:
+            self.finish()
+            
+        self.size += len(data)
+        if self.max_body_size is not None and self.size > self.max_body_size:
+            self.abort()
+            raise ResponseTooLarge("Response from %s is larger than %d bytes" % (self.url, self.max_body_size))
+            
+        return data
+        
+    def tell(self):
+        return self.size - len(self.buffer)
+        
+    def finish(self):
+        ''' the body has been read, hand the connection back '''
+        
+        self.done = True
+        if self.conn is not None:
+            if self.response.will_close:
+                self.pool.discard(self.key, self.conn)
+            else:
+                self.pool.checkin(self.key, self.conn)
+            self.conn = None
+            
+    def abort(self):
+        ''' give up on the body, the connection can't be reused '''
+        
+        self.done = True
+        if self.conn is not None:
+            self.pool.discard(self.key, self.conn)
+            self.conn = None
+            
+    def close(self):
+        if not self.done:
+            self.abort()
+
+
+class ConnectionPool(object):
+    ''' Keep-alive HTTP connections, pooled per host so repeated requests skip the TCP connect and DNS lookup.
+    
+        max_idle_per_host - most idle connections kept open for one host.  (extras are closed when returned)
+        max_connections_per_host - most connections to one host in use at once, None for no limit.  A request past that
+                                   waits up to connect_timeout for one to be returned, then raises PoolTimeout.
+        idle_timeout - seconds an idle connection is kept before it is closed.
+        connect_timeout - seconds to wait to connect, None for the global socket default.
+        read_timeout - seconds to wait on each read of a response (so for the headers, then each chunk of the body), 
+                       None for the global socket default.
+        timeout - if given, used for both connect_timeout and read_timeout.
+        gzip - ask for gzip'ed responses and decompress them.
+    '''
+    
+    def __init__(self, max_idle_per_host=4, max_connections_per_host=None, idle_timeout=30.0,
+                 connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, timeout=None, gzip=True):
+        self.max_idle_per_host = max_idle_per_host
+        self.max_connections_per_host = max_connections_per_host
+        self.idle_timeout = idle_timeout
+        if timeout is not None:
+            connect_timeout = read_timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.gzip = gzip
+        
+        self.lock = threading.Condition()
+        self.idle = {}  # (scheme, host, port) -> list of (connection, time it was returned to the pool)
+        self.busy = {}  # (scheme, host, port) -> connections checked out
+        
+    def get(self, url, max_body_size=None):
+        ''' do a GET on a pooled connection, return the (decompressed) response body '''
+        
+        f = self.open(url, max_body_size)
+        try:
+            return f.read()
+        finally:
+            f.close()
+            
+    def open(self, url, max_body_size=None):
+        ''' Do a GET on a pooled connection, return the response body as a ResponseStream.
+        
+            max_body_size - raise ResponseTooLarge if the (decompressed) body gets longer than this many bytes.
+        '''
+        
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+            
+        headers = {}
+        if self.gzip:
+            headers["Accept-Encoding"] = "gzip"
+        
+        try:
+            (conn, reused) = self.checkout(key)
+            try:
+                response = self.request(conn, path, headers)
+            except (httplib.HTTPException, socket.error), e:
+                if not reused or isinstance(e, socket.timeout):
+                    raise
+                    
+                # the server probably dropped the idle connection on its end.  try once more on a new one:
+                conn.close()
+                conn = self.connect(key)
+                response = self.request(conn, path, headers)
+                
+        except (httplib.HTTPException, socket.error), e:
+            self.discard(key, conn)
+            logger.error("Failed to get %s via connection pool" % url)
+            raise urllib2.URLError(e)
+            
+        f = ResponseStream(self, key, conn, response, url, max_body_size)
+        
+        length = response.getheader("content-length")
+        if max_body_size is not None and length and length.isdigit() and int(length) > max_body_size:
+            # (a gzip'ed length this big would only inflate to more)
+            f.abort()
+            raise ResponseTooLarge("Response from %s is %s bytes, larger than %d" % (url, length, max_body_size))
+            
+        if response.status != 200:
+            body = f.read()
+            logger.error("Failed to get %s via connection pool.  HTTP status code was %d" % (url, response.status))
+            raise urllib2.HTTPError(url, response.status, response.reason, response.msg, StringIO(body))
+            
+        return f
+        
+    def request(self, conn, path, headers):
+        if conn.sock is None:
+            # connect under connect_timeout, then wait for responses under read_timeout
+            conn.connect()
+            read_timeout = self.read_timeout
+            if read_timeout is None:
+                # (settimeout(None) would block forever, not fall back on the default)
+                read_timeout = socket.getdefaulttimeout()
+            conn.sock.settimeout(read_timeout)
+        conn.request("GET", path, headers=headers)
+        return conn.getresponse()
+        
+    def checkout(self, key):
+        ''' Return (connection, reused) for this host, reusing an idle connection if there is a fresh one.
+        
+            Hand the connection back with checkin, or discard if it can't be reused.
+        '''
+        
+        now = time.time()
+        stale = []
+        conn = None
+        
+        self.lock.acquire()
+        try:
+            limit = self.max_connections_per_host
+            if limit is not None:
+                deadline = None
+                if self.connect_timeout is not None:
+                    deadline = now + self.connect_timeout
+                while self.busy.get(key, 0) >= limit:
+                    wait = None
+                    if deadline is not None:
+                        wait = deadline - time.time()
+                        if wait <= 0:
+                            raise PoolTimeout("All %d connections to %s are in use" % (limit, key[1]))
+                    self.lock.wait(wait)
+            self.busy[key] = self.busy.get(key, 0) + 1
+            
+            idle = self.idle.get(key, [])
+            while idle:
+                (c, returned) = idle.pop()
+                if now - returned < self.idle_timeout:
+                    conn = c
+                    break
+                stale.append(c)
+        finally:
+            self.lock.release()
+            
+        for c in stale:
+            c.close()
+            
+        if conn is not None:
+            return (conn, True)
+            
+        return (self.connect(key), False)
+        
+    def checkin(self, key, conn):
+        ''' return a connection to the pool, or close it if the pool for this host is full '''
+        
+        self.lock.acquire()
+        try:
+            self.returned(key)
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.max_idle_per_host:
+                idle.append((conn, time.time()))
+                conn = None
+        finally:
+            self.lock.release()
+            
+        if conn is not None:
+            conn.close()
+            
+    def discard(self, key, conn):
+        ''' close a checked out connection that can't be reused '''
+        
+        conn.close()
+        self.lock.acquire()
+        try:
+            self.returned(key)
+        finally:
+            self.lock.release()
+            
+    def returned(self, key):
+        ''' a connection checked out for key is back.  (called holding the lock) '''
+        
+        self.busy[key] -= 1
+        if not self.busy[key]:
+            del self.busy[key]
+        # (waiters may be after other hosts, wake them all)
+        self.lock.notify_all()
+            
+    def connect(self, key):
+        ''' open a new connection to this host '''
+        
+        (scheme, host, port) = key
+        if scheme == "https":
+            cls = httplib.HTTPSConnection
+        else:
+            cls = httplib.HTTPConnection
+            
+        if self.connect_timeout is None:
+            return cls(host, port)
+        return cls(host, port, timeout=self.connect_timeout)
+        
+    def evict_idle(self):
+        ''' close every connection that has been idle longer than idle_timeout '''
+        
+        now = time.time()
+        stale = []
+        
+        self.lock.acquire()
+        try:
+            for (key, idle) in self.idle.items():
+                fresh = [(c, returned) for (c, returned) in idle if now - returned < self.idle_timeout]
+                stale.extend([c for (c, returned) in idle if now - returned >= self.idle_timeout])
+                self.idle[key] = fresh
+        finally:
+            self.lock.release()
+            
+        for c in stale:
+            c.close()
+            
+    def close(self):
+        ''' close all idle connections '''
+        
+        self.lock.acquire()
+        try:
+            idle = self.idle
+            self.idle = {}
+        finally:
+            self.lock.release()
+            
+        for conns in idle.values():
+            for (c, returned) in conns:
+                c.close()
+                
+                
+class CircuitOpen(urllib2.URLError):
+    ''' the endpoint's circuit breaker is open, the request wasn't sent '''
+    pass
+
 
+def endpoint(url):
+    ''' (scheme, host, port) a url is sent to, what circuit breakers and latencies are kept per '''
     
-def get(url):
-    ''' do a simple synchronous get request for this URL '''
+    parts = urlparse.urlsplit(url)
+    return (parts.scheme, parts.hostname, parts.port)
+
+
+def is_failure(error):
+    ''' True if error says the endpoint is unhealthy: it couldn't be reached, timed out, or failed with a 5xx.
+    
+        503 is amazon throttling us, not failing, and a 4xx or an oversized response is the request's fault.  A
+        PoolTimeout is our own pool being busy.
+    '''
+    
+    if isinstance(error, (CircuitOpen, ResponseTooLarge, PoolTimeout)):
+        return False
+    if isinstance(error, urllib2.HTTPError):
+        return error.code >= 500 and error.code != 503
+    return isinstance(error, (urllib2.URLError, httplib.HTTPException, socket.error))
+
+
+class CircuitBreaker(object):
+    ''' Stops requests to an endpoint that keeps failing, so callers fail fast instead of each waiting out a timeout.
+    
+        After failure_threshold failures in a row the circuit opens and requests are refused for reset_timeout seconds.
+        Then one trial request is let through (half open): the circuit closes if it succeeds and opens again if not.
+    '''
+    
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half open"
+    
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0       # in a row
+        self.opened = 0.0       # time the circuit last opened
+        self.trial = False      # a half open trial request is in flight
+        
+    def allow(self, now=None):
+        ''' True if a request may be sent now '''
+        
+        if now is None:
+            now = time.time()
+            
+        self.lock.acquire()
+        try:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and now - self.opened >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN and not self.trial:
+                self.trial = True
+                return True
+            return False
+        finally:
+            self.lock.release()
+            
+    def success(self):
+        self.lock.acquire()
+        try:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.trial = False
+        finally:
+            self.lock.release()
+            
+    def failure(self, now=None):
+        ''' record a failure, return True if it opened the circuit '''
+        
+        if now is None:
+            now = time.time()
+            
+        self.lock.acquire()
+        try:
+            self.failures += 1
+            self.trial = False
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self.opened = now
+                return True
+            return False
+        finally:
+            self.lock.release()
+
+
+class RetryBudget(object):
+    ''' Retries allowed as a share of recent requests, so retrying can't multiply the load on an endpoint that's 
+        already struggling.
+    
+        ratio - retries allowed per request made in the last window seconds...
+        min_retries - ...plus this many in any window, so a quiet client can still retry.
+    '''
+    
+    def __init__(self, ratio=0.2, min_retries=10, window=10.0):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.window = window
+        
+        self.lock = threading.Lock()
+        self.requests = deque() # times of requests in the window
+        self.retries = deque()  # times of retries in the window
+        
+    def expire(self, now):
+        for times in (self.requests, self.retries):
+            while times and now - times[0] > self.window:
+                times.popleft()
+                
+    def request(self, now=None):
+        ''' count a request '''
+        
+        if now is None:
+            now = time.time()
+            
+        self.lock.acquire()
+        try:
+            self.expire(now)
+            self.requests.append(now)
+        finally:
+            self.lock.release()
+            
+    def retry(self, now=None):
+        ''' True (and count it) if there's budget for a retry now '''
+        
+        if now is None:
+            now = time.time()
+            
+        self.lock.acquire()
+        try:
+            self.expire(now)
+            if len(self.retries) >= self.min_retries + self.ratio * len(self.requests):
+                return False
+            self.retries.append(now)
+            return True
+        finally:
+            self.lock.release()
+
+
+class LatencyWindow(object):
+    ''' the last size latencies seen from an endpoint '''
+    
+    def __init__(self, size=200):
+        self.samples = deque(maxlen=size)
+        
+    def add(self, seconds):
+        self.samples.append(seconds)
+        
+    def percentile(self, p):
+        samples = sorted(self.samples)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+
+
+# HTTP statuses worth retrying.  503 is left out: that's amazon throttling the key, which throttle.RequestScheduler
+# backs off for as a whole rather than per request.
+RETRY_STATUSES = (500, 502, 504)
+
+
+def is_retryable(error, retry_statuses=RETRY_STATUSES):
+    ''' True if error is a failure the same request might not get next time '''
+    
+    if isinstance(error, urllib2.HTTPError):
+        return error.code in retry_statuses
+    return is_failure(error)
+
+
+def _discard(value):
+    ''' let go of a hedged request's response that lost the race '''
+    
+    if hasattr(value, "close"):
+        value.close()
+
+
+class ResiliencePolicy(object):
+    ''' How requests survive a slow or flaky endpoint: retries with backoff under a retry budget, a circuit breaker per 
+        endpoint, and optionally hedged requests.
+    
+        max_retries - times a failed request is retried.  (connection errors, timeouts and retry_statuses)
+        backoff - seconds to wait before the first retry, doubled each retry up to max_backoff.  jittered.
+        retry_budget - RetryBudget shared by every request made under this policy.
+        failure_threshold, reset_timeout - for each endpoint's CircuitBreaker.  failure_threshold None for no breakers.
+        hedge_percentile - if a response hasn't come back after this percentile of the endpoint's recent latencies, 
+                           send the same request again and take whichever answers first.  None to not hedge.  Hedges 
+                           come out of the retry budget, and cost a request's worth of quota each.
+        min_hedge_delay - never hedge sooner than this many seconds in.
+        hedge_min_samples - latencies seen from an endpoint before it is hedged.
+        
+        Pass it to net.get (or ProductAdvertisingAPI's policy=).  A streamed response is covered up to its headers, 
+        errors reading the body later are up to the reader.
+    '''
+    
+    def __init__(self, max_retries=2, backoff=0.2, max_backoff=5.0, retry_statuses=RETRY_STATUSES, retry_budget=None,
+                 failure_threshold=5, reset_timeout=30.0, hedge_percentile=None, min_hedge_delay=0.05,
+                 hedge_min_samples=20):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_statuses = retry_statuses
+        if retry_budget is None:
+            retry_budget = RetryBudget()
+        self.retry_budget = retry_budget
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.hedge_percentile = hedge_percentile
+        self.min_hedge_delay = min_hedge_delay
+        self.hedge_min_samples = hedge_min_samples
+        
+        self.lock = threading.Lock()
+        self.breakers = {}      # endpoint -> CircuitBreaker
+        self.latencies = {}     # endpoint -> LatencyWindow of successful requests
+        
+        # metrics
+        self.requests = 0
+        self.retries = 0
+        self.retries_denied = 0 # retries the budget wouldn't allow
+        self.rejected = 0       # requests refused by an open circuit
+        self.hedges = 0
+        self.hedge_wins = 0     # hedges that answered first
+        
+    def breaker(self, key):
+        self.lock.acquire()
+        try:
+            breaker = self.breakers.get(key)
+            if breaker is None:
+                breaker = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+                self.breakers[key] = breaker
+            return breaker
+        finally:
+            self.lock.release()
+            
+    def count(self, name):
+        self.lock.acquire()
+        try:
+            setattr(self, name, getattr(self, name) + 1)
+        finally:
+            self.lock.release()
+            
+    def call(self, url, func):
+        ''' return func(), which requests url, retrying, hedging and circuit breaking it as the policy says '''
+        
+        key = endpoint(url)
+        if self.failure_threshold is None:
+            breaker = None
+        else:
+            breaker = self.breaker(key)
+            
+        self.count("requests")
+        self.retry_budget.request()
+        
+        attempt = 0
+        error = None    # exc_info of the last attempt's failure
+        while True:
+            if breaker is not None and not breaker.allow():
+                self.count("rejected")
+                if error is not None:
+                    # opened by another request while this one waited to retry.  what went wrong is more use than CircuitOpen:
+                    raise error[0], error[1], error[2]
+                raise CircuitOpen("Circuit open for %s://%s, not sending %s" % (key[0], key[1], url))
+                
+            try:
+                value = self.hedged(key, func)
+            except Exception, e:
+                opened = False
+                if breaker is not None:
+                    if is_failure(e):
+                        opened = breaker.failure()
+                        if opened:
+                            logger.warning("Circuit opened for %s://%s for %.1f seconds" % (key[0], key[1], 
+                                                                                            self.reset_timeout))
+                    else:
+                        breaker.success()
+                        
+                # (once this request has opened the circuit, a retry would only be refused with CircuitOpen)
+                if opened or not is_retryable(e, self.retry_statuses) or attempt >= self.max_retries:
+                    raise
+                if not self.retry_budget.retry():
+                    self.count("retries_denied")
+                    raise
+                    
+                delay = min(self.max_backoff, self.backoff * (2 ** attempt))
+                delay = random.uniform(delay / 2.0, delay)
+                logger.warning("Retrying %s in %.2f seconds (%s)" % (url, delay, e))
+                self.count("retries")
+                error = sys.exc_info()
+                time.sleep(delay)
+                attempt += 1
+                continue
+                
+            if breaker is not None:
+                breaker.success()
+            return value
+            
+    def hedge_delay(self, key):
+        ''' seconds to wait before hedging a request to this endpoint, None to not hedge it '''
+        
+        if self.hedge_percentile is None:
+            return None
+            
+        self.lock.acquire()
+        try:
+            window = self.latencies.get(key)
+            if window is None or len(window.samples) < self.hedge_min_samples:
+                return None
+            return max(self.min_hedge_delay, window.percentile(self.hedge_percentile))
+        finally:
+            self.lock.release()
+            
+    def record_latency(self, key, seconds):
+        self.lock.acquire()
+        try:
+            window = self.latencies.get(key)
+            if window is None:
+                window = LatencyWindow()
+                self.latencies[key] = window
+            window.add(seconds)
+        finally:
+            self.lock.release()
+            
+    def timed(self, key, func):
+        start = time.time()
+        value = func()
+        self.record_latency(key, time.time() - start)
+        return value
+        
+    def hedged(self, key, func):
+        ''' return func(), or if it's slow a second func() started hedge_delay in, whichever returns first '''
+        
+        delay = self.hedge_delay(key)
+        if delay is None:
+            return self.timed(key, func)
+            
+        results = Queue.Queue()
+        
+        def attempt(hedge):
+            try:
+                results.put((hedge, True, self.timed(key, func)))
+            except Exception:
+                results.put((hedge, False, sys.exc_info()))
+                
+        def start(hedge):
+            t = threading.Thread(target=attempt, args=(hedge,))
+            t.daemon = True
+            t.start()
+            
+        start(False)
+        pending = 1
+        try:
+            result = results.get(timeout=delay)
+        except Queue.Empty:
+            if self.retry_budget.retry():
+                self.count("hedges")
+                start(True)
+                pending += 1
+            result = results.get()
+        pending -= 1
+        
+        (hedge, ok, value) = result
+        if not ok and pending:
+            # the other one may still come through
+            (hedge, ok, value) = results.get()
+            pending -= 1
+            
+        if pending:
+            # close the loser's response whenever it turns up
+            def drain():
+                (h, loser_ok, loser) = results.get()
+                if loser_ok:
+                    _discard(loser)
+            t = threading.Thread(target=drain)
+            t.daemon = True
+            t.start()
+            
+        if not ok:
+            raise value[0], value[1], value[2]
+        if hedge:
+            self.count("hedge_wins")
+        return value
+        
+    def stats(self):
+        ''' retry, circuit breaker and hedging metrics as a dict '''
+        
+        self.lock.acquire()
+        try:
+            return {
+                "requests": self.requests,
+                "retries": self.retries,
+                "retries_denied": self.retries_denied,
+                "rejected": self.rejected,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "open_circuits": len([b for b in self.breakers.values() if b.state != CircuitBreaker.CLOSED]),
+            }
+        finally:
+            self.lock.release()
+                
+                
+# shared by every ProductAdvertisingAPI that isn't given its own pool:
+default_pool = ConnectionPool()
+
+    
+def get(url, pool=None, stream=False, max_body_size=None, policy=None):
+    ''' do a simple synchronous get request for this URL 
+    
+        pool - ConnectionPool to make the request on, default_pool if None.  (only its read_timeout is used on app engine)
+        stream - if True, return the pool's ResponseStream, which reads the body off the connection as it's read, rather
+                 than reading it all into memory first.  (app engine reads it all anyway)
+        max_body_size - raise ResponseTooLarge if the body is longer than this many bytes.
+        policy - ResiliencePolicy to retry, circuit break and hedge the request under, None to just make it once.
+    '''
     
     #logger.debug("GET %s" % url)
     
+    if policy is not None:
+        return policy.call(url, lambda: get(url, pool, stream, max_body_size))
     
+    if pool is None:
+        pool = default_pool
+        
     if app_engine:
-        s = app_engine_get(url)
+        s = app_engine_get(url, pool.read_timeout)
+        if max_body_size is not None and len(s) > max_body_size:
+            raise ResponseTooLarge("Response from %s is %d bytes, larger than %d" % (url, len(s), max_body_size))
     else:
-        s = standard_lib_get(url)
+        if stream:
+            return pool.open(url, max_body_size)
+        s = pool.get(url, max_body_size)
         
     # Still a string of bytes, not *decoded* into utf-8 yet, though all amazon responses should be utf-8 judging by the Content-Type response header.
     # Be Verrrrrrry careful with unicode handling.
@@ -1,36 +1,126 @@
 # http://aws.amazon.com/archives/Product-Advertising-API/4044124515194371
 
+import array
 import base64
+import bisect
+import copy
 import hashlib
 import hmac
 import logging
 logger = logging.getLogger("amazon")
-logger.setLevel(logging.INFO)
 
 from optparse import OptionParser
+import random
 import sys
 import time
 import urllib
+from cStringIO import StringIO
 from xml.etree import ElementTree as ET
 
+import metrics as _metrics
 import net
+import throttle
+import workers
 
 ASSOCIATE_TAG = "<your associate tag>"
 AWS_KEY = "<your aws key>"
 AWS_SECRET = "<your aws secret>"
 
-class Product(object):
+MAX_LOOKUP_ITEMS = 10   # most ItemIds ItemLookup accepts in one request
+
+NAN = float("nan")
+
+NULL_METRICS = _metrics.NullMetrics()
+
+class Diagnostics(object):
+    ''' What one response's items were missing, counted up and logged as a single line rather than a line per item.
+    
+        Only made when the logger is enabled for level, so conversion does none of this otherwise.  sample is the 
+        fraction of converted products to also log in full.
+    '''
+    
+    __slots__ = ("level", "sample", "counts", "examples", "items")
+    
+    max_examples = 3
+    
+    def __init__(self, level, sample=0.0):
+        self.level = level
+        self.sample = sample
+        self.counts = {}    # reason -> number of items
+        self.examples = {}  # reason -> first few ASINs
+        self.items = 0
+        
+    def add(self, reason, asin):
+        self.counts[reason] = self.counts.get(reason, 0) + 1
+        examples = self.examples.setdefault(reason, [])
+        if len(examples) < self.max_examples:
+            examples.append(asin)
+        
+    def check(self, names, item, product):
+        ''' count whatever product is missing, and maybe log it '''
+        
+        self.items += 1
+        
+        # no offer summary response group for Kindle books (others too, perhaps?)
+        if product.lowest_new_price is None and names.OfferSummary in names.item_handlers:
+            offer_summary = item.find(names.OfferSummary)
+            if offer_summary is None:
+                self.add("OfferSummary", product.asin)
+            else:
+                lowest_new_price = offer_summary.find(names.LowestNewPrice)
+                if lowest_new_price is None:
+                    self.add("LowestNewPrice", product.asin)
+                else:
+                    self.add("LowestNewPrice Amount", product.asin)
+                    
+        if self.sample and random.random() < self.sample:
+            logger.log(self.level, "Converted %s", product)
+            
+    def log(self, description):
+        ''' one line for everything counted, with the counts as the record's "diagnostics" attribute for handlers that want them '''
+        
+        missing = ["%d lacked %s (%s)" % (count, reason, ", ".join(self.examples[reason]))
+                   for (reason, count) in sorted(self.counts.items())]
+                   
+        logger.log(self.level, "Converted %d items to %s%s", self.items, description, "".join(["; " + m for m in missing]),
+                   extra={"diagnostics": {"items": self.items, "missing": dict(self.counts)}})
+                   
+
+class SlotsPickle(object):
+    ''' Pickling for a class with __slots__: python 2 won't pickle one at protocols 0 and 1 (the pickle and cPickle
+        default) without __getstate__.  The state is a tuple of the slot values.
+    '''
+    
+    __slots__ = ()
+    
+    def __getstate__(self):
+        return tuple([getattr(self, name, None) for name in self.__slots__])
+        
+    def __setstate__(self, state):
+        for (name, value) in zip(self.__slots__, state):
+            setattr(self, name, value)
+            
+
+class Product(SlotsPickle):
     ''' individual product result information '''
     
+    __slots__ = ("asin", "detail_url", "category", "title", "author", "actors", "artists", "lowest_new_price",
+                 "small_image_url", "medium_image_url", "large_image_url", "sales_rank")
+    
     def __init__(self):
+        self.clear()
+        
+    def clear(self):
+        ''' reset every field '''
+        
         self.asin = None
         self.detail_url = None
         self.category = None   # e.x. Book, DVD, Apparel, Toy, Movie
         self.title = None       # product title
         
         self.author = None      # author, probably only available for books.
-        self.actors = []        # actor(s), probably only available for movies/tv shows/etc
-        self.artists = []       # artist(s), probably only available for music
+        self.actors = ()        # actor(s) tuple, probably only available for movies/tv shows/etc
+        self.artists = ()       # artist(s) tuple, probably only available for music
         
         self.lowest_new_price = None       # new lowest price, as a float 
         
@@ -44,8 +134,122 @@ class Product(object):
         return "ASIN %s %s\t%s (#%s)" % (self.asin, self.category, self.title.encode("ascii", "ignore"), self.sales_rank)
   
 
-class ItemLookupResponse(object):
+class LazyProduct(Product):
+    ''' A Product that keeps its Item element and only scrapes a field out of it the first time the field is read.
+    
+        Fields come from the Item's children in groups (title, author, category, actors and artists all come from 
+        ItemAttributes), so reading one decodes and keeps the rest of its group too.  Fields left out of a projection
+        (see XMLNames.project) read as empty.  The Item element is held until the product is dropped, use 
+        materialize() for a plain Product to keep around.
+    '''
+    
+    __slots__ = ("item", "names")
+    
+    def __init__(self, item, names):
+        # fields are left unset, reading one ends up in __getattr__
+        self.item = item
+        self.names = names
+        
+    def __getattr__(self, field):
+        # only called when normal lookup fails, i.e. for fields not decoded yet
+        if field in ("item", "names"):
+            raise AttributeError(field)
+            
+        names = self.names
+        group = names.field_groups.get(field)
+        if group is None:
+            raise AttributeError(field)
+            
+        (tag, fields) = group
+        for f in fields:
+            setattr(self, f, FIELD_DEFAULTS.get(f))
+            
+        handler = names.item_handlers.get(tag)
+        if handler is not None:
+            element = self.item.find(tag)
+            if element is not None:
+                handler(names, self, element)
+                
+        return getattr(self, field)
+        
+    def __reduce_ex__(self, protocol):
+        # the Item element can't be pickled, pickle what it decodes to
+        return (Product, (), self.materialize().__getstate__())
+        
+    def materialize(self):
+        ''' every field decoded into a plain Product '''
+        
+        product = Product()
+        for field in Product.__slots__:
+            setattr(product, field, getattr(self, field))
+        return product
+        
+
+class ProductBatch(SlotsPickle):
+    ''' Columnar set of products: one column per Product field, row i of every column is product i.
+    
+        Much smaller than a list of Products when holding lots of them.  Prices are an array of doubles (NaN where 
+        there's no price) and sales ranks an array of longs (-1 where there's no rank).  Everything else is a list.
+    '''
+    
+    __slots__ = ("asin", "detail_url", "category", "title", "author", "actors", "artists", "lowest_new_price",
+                 "small_image_url", "medium_image_url", "large_image_url", "sales_rank")
+                 
+    object_columns = ("asin", "detail_url", "category", "title", "author", "actors", "artists",
+                      "small_image_url", "medium_image_url", "large_image_url")
+    
+    def __init__(self):
+        for column in self.object_columns:
+            setattr(self, column, [])
+        self.lowest_new_price = array.array("d")
+        self.sales_rank = array.array("l")
+        
+    def __len__(self):
+        return len(self.asin)
+        
+    def __iter__(self):
+        for i in xrange(len(self.asin)):
+            yield self.product(i)
+        
+    def append(self, product):
+        ''' add a row copied from product '''
+        
+        for column in self.object_columns:
+            getattr(self, column).append(getattr(product, column))
+        
+        if product.lowest_new_price is None:
+            self.lowest_new_price.append(NAN)
+        else:
+            self.lowest_new_price.append(product.lowest_new_price)
+            
+        if product.sales_rank is None:
+            self.sales_rank.append(-1)
+        else:
+            self.sales_rank.append(int(product.sales_rank))
+            
+    def product(self, i):
+        ''' row i as a Product '''
+        
+        product = Product()
+        for column in self.object_columns:
+            setattr(product, column, getattr(self, column)[i])
+            
+        price = self.lowest_new_price[i]
+        if price == price:  # not NaN
+            product.lowest_new_price = price
+            
+        rank = self.sales_rank[i]
+        if rank >= 0:
+            product.sales_rank = str(rank)
+            
+        return product
+        
+
+class ItemLookupResponse(SlotsPickle):
     ''' item lookup response information encapsulated here. '''
+    
+    __slots__ = ("request_id", "is_valid", "product")
+    
     def __init__(self):
         self.request_id = None
         self.is_valid = False
@@ -55,22 +259,27 @@ class ItemLookupResponse(object):
         return "Request id: %s, valid: %d, product %s" % (self.request_id, self.is_valid, self.product.asin)
 
 
-class ItemSearchResponse(object):
+class ItemSearchResponse(SlotsPickle):
     ''' item search response information encapsulated here. '''
+    
+    __slots__ = ("request_id", "is_valid", "num_results", "num_pages", "products")
+    
     def __init__(self):
         self.request_id = None
         self.is_valid = False
         self.num_results = 0
         self.num_pages = 0
-        self.products = []
+        self.products = []  # list of Product, a generator of them when streamed, or a ProductBatch
         
     def __str__(self):
         return "Request id: %s, valid: %d, num_results: %d, pages: %d" % (self.request_id, self.is_valid, 
                     self.num_results, self.num_pages)
         
-class BrowseNode(object):
+class BrowseNode(SlotsPickle):
     ''' info for a single browse node. '''
     
+    __slots__ = ("node_id", "name", "category_root")
+    
     def __init__(self):
         self.node_id = -1
         self.name = None
@@ -85,9 +294,11 @@ class BrowseNode(object):
         return "%s (%d) (root: %s)" % (self.name, self.node_id, root)
         
         
-class BrowseNodeLookupResponse(object):
+class BrowseNodeLookupResponse(SlotsPickle):
     ''' browse node lookup response encapsulated here. '''
     
+    __slots__ = ("request_id", "is_valid", "node", "children", "ancestors")
+    
     def __init__(self):
         self.request_id = None
         self.is_valid = False
@@ -110,14 +321,315 @@ class BrowseNodeLookupResponse(object):
             sys.stdout.write("\n    ")
             sys.stdout.write(str(c))
         print ""
+
+# Item scraping is a single pass over each Item's children, dispatching on tag to one of these handlers.  Each takes
+# (names, product, element) where names is the XMLNames for the response's namespace.
+
+# Item child -> the Product fields it fills in
+ITEM_FIELDS = {
+    "ASIN": ("asin",),
+    "DetailPageURL": ("detail_url",),
+    "SalesRank": ("sales_rank",),
+    "ItemAttributes": ("category", "title", "author", "actors", "artists"),
+    "OfferSummary": ("lowest_new_price",),
+    "SmallImage": ("small_image_url",),
+    "MediumImage": ("medium_image_url",),
+    "LargeImage": ("large_image_url",),
+}
+
+# ItemAttributes child -> the Product fields it fills in
+ATTRIBUTE_FIELDS = {
+    "Actor": ("actors",),
+    "Artist": ("artists",),
+    "ProductGroup": ("category",),
+    "Title": ("title",),
+    "Author": ("author",),
+}
+
+# a field's value when the item doesn't have it, None if not listed
+FIELD_DEFAULTS = {
+    "actors": (),
+    "artists": (),
+}
+
+def _item_asin(names, product, element):
+    product.asin = element.text
+    
+def _item_detail_url(names, product, element):
+    product.detail_url = element.text
+    
+def _item_sales_rank(names, product, element):
+    product.sales_rank = element.text
+    
+def _item_attributes(names, product, element):
+    # stuff like actor, product group, etc is in the item attributes block
+    handlers = names.attribute_handlers
+    for child in element:
+        handler = handlers.get(child.tag)
+        if handler is not None:
+            handler(names, product, child)
+            
+    # mp3 downloads appear to have a Creator field instead of an artist.  if we didn't find an artist, check for creator:
+    if len(product.artists) == 0 and names.Artist in handlers:
+        creator = element.find(names.Creator)
+        if creator is not None:
+            product.artists = (creator.text,)
+    
+def _item_offer_summary(names, product, element):
+    # get pricing information from OfferSummary group:
+    # (items missing a price are counted by Diagnostics, not logged here)
+    lowest_new_price = element.find(names.LowestNewPrice)
+    
+    if lowest_new_price is not None:
+        amt = lowest_new_price.find(names.Amount)
+        if amt is not None:
+            # the Amount field is given as "1699", meaning $16.99
+            product.lowest_new_price = int(amt.text) / 100.0
+    
+def _item_small_image(names, product, element):
+    image = element.find(names.URL)
+    if image is not None:
+        product.small_image_url = image.text
+
+def _item_medium_image(names, product, element):
+    image = element.find(names.URL)
+    if image is not None:
+        product.medium_image_url = image.text
+
+def _item_large_image(names, product, element):
+    image = element.find(names.URL)
+    if image is not None:
+        product.large_image_url = image.text
+    
+def _attribute_actor(names, product, element):
+    product.actors += (element.text,)
+    
+def _attribute_artist(names, product, element):
+    product.artists += (element.text,)
+    
+def _attribute_product_group(names, product, element):
+    product.category = element.text
+    
+def _attribute_title(names, product, element):
+    product.title = element.text
+    
+def _attribute_author(names, product, element):
+    # i think this is only available for books.  keep the first (primary) author:
+    if product.author is None:
+        product.author = element.text
+
+
+class XMLNames(object):
+    ''' Every element tag and xpath used to scrape responses, built once per xml namespace.
+    
+        Tags are plain "{xmlns}Name" strings, which is what str(ET.QName(xmlns, name)) gives, so lookups in the parsing 
+        loops don't need to build or format anything.
+    '''
+    
+    tags = (
+        "OperationRequest", "RequestId", "Request", "IsValid", "Errors", "Error", "Code", "Message",
+        "Items", "Item", "TotalResults", "TotalPages",
+        "ASIN", "DetailPageURL", "SalesRank", "ItemAttributes", "OfferSummary", "LowestNewPrice", "Amount",
+        "SmallImage", "MediumImage", "LargeImage", "URL",
+        "Actor", "Artist", "Creator", "ProductGroup", "Title", "Author",
+        "BrowseNodes", "BrowseNode", "BrowseNodeId", "Name", "IsCategoryRoot", "Ancestors", "Children",
+    )
+    
+    def __init__(self, xmlns):
+        self.xmlns = xmlns
+        
+        for name in self.tags:
+            setattr(self, name, "{%s}%s" % (xmlns, name))
+            
+        self.request_id_path = "%s/%s" % (self.OperationRequest, self.RequestId)
+        self.isvalid_path = "%s/%s" % (self.Request, self.IsValid)
+        self.errors_path = "%s/%s/%s" % (self.Request, self.Errors, self.Error)
+        
+        # Item child tag -> handler
+        self.item_handlers = {
+            self.ASIN: _item_asin,
+            self.DetailPageURL: _item_detail_url,
+            self.SalesRank: _item_sales_rank,
+            self.ItemAttributes: _item_attributes,
+            self.OfferSummary: _item_offer_summary,
+            self.SmallImage: _item_small_image,
+            self.MediumImage: _item_medium_image,
+            self.LargeImage: _item_large_image,
+        }
+        
+        # ItemAttributes child tag -> handler
+        self.attribute_handlers = {
+            self.Actor: _attribute_actor,
+            self.Artist: _attribute_artist,
+            self.ProductGroup: _attribute_product_group,
+            self.Title: _attribute_title,
+            self.Author: _attribute_author,
+        }
+        
+        # Product field -> (Item child tag it's in, every field that tag fills in)
+        self.field_groups = {}
+        for (name, fields) in ITEM_FIELDS.items():
+            for field in fields:
+                self.field_groups[field] = (getattr(self, name), fields)
+                
+        self.projections = {}
+        
+    def project(self, fields):
+        ''' A copy of these names whose handlers only scrape fields (Product field names), or these names if fields is 
+            None.  Item children none of the fields come from are skipped without being looked at.
+        '''
+        
+        if fields is None:
+            return self
+            
+        key = frozenset(fields)
+        names = self.projections.get(key)
+        if names is None:
+            unknown = key.difference(self.field_groups)
+            if unknown:
+                raise Exception("Unknown product fields: %s" % ", ".join(sorted(unknown)))
+                
+            names = copy.copy(self)
+            names.item_handlers = dict([(getattr(self, name), self.item_handlers[getattr(self, name)]) 
+                                        for (name, filled) in ITEM_FIELDS.items() if key.intersection(filled)])
+            names.attribute_handlers = dict([(getattr(self, name), self.attribute_handlers[getattr(self, name)]) 
+                                             for (name, filled) in ATTRIBUTE_FIELDS.items() if key.intersection(filled)])
+            self.projections[key] = names
+            
+        return names
+        
+        
+_xml_names = {}
+
+def xml_names(xmlns):
+    ''' return the (shared) XMLNames for this namespace, building it on first use '''
+    
+    names = _xml_names.get(xmlns)
+    if names is None:
+        names = XMLNames(xmlns)
+        _xml_names[xmlns] = names
+        
+    return names
+    
+        
+class RequestSigner(object):
+    ''' Builds signed request urls for one host and set of credentials.
+    
+        The parts that are the same for every request are done once: the HMAC's inner and outer hashes are keyed (and 
+        the inner one fed the "GET\nhost\n/onca/xml\n" prefix) up front and copied per request, and the static 
+        parameters (Service, AWSAccessKeyId, AssociateTag, Version) are encoded once and only merged in with each 
+        request's own few parameters.
+    '''
+    
+    max_quoted = 1024   # most distinct parameter values kept url-quoted
+    
+    def __init__(self, host, aws_key, aws_secret, associate_tag, api_version):
+        self.host = host
+        self.url_prefix = "http://%s/onca/xml?" % host
+        self.sign_prefix = "GET\n%s\n/onca/xml\n" % host
+        
+        h = hmac.new(aws_secret, self.sign_prefix, hashlib.sha256)
+        self.inner = h.inner
+        self.outer = h.outer
+        
+        static = [
+            "Service=AWSECommerceService",
+            "AWSAccessKeyId=" + aws_key,
+            "Version=" + api_version,
+        ]
+        if associate_tag:
+            static.append("AssociateTag=" + associate_tag)
+        self.static_params = static
+        
+        self.quoted = {}            # parameter value -> url-quoted value
+        self.last_timestamp = (None, None)  # (epoch second, quoted Timestamp param)
+        
+    def quote(self, value):
+        quoted = self.quoted.get(value)
+        if quoted is None:
+            quoted = urllib.quote(value)
+            if len(self.quoted) >= self.max_quoted:
+                self.quoted.clear()
+            self.quoted[value] = quoted
+        return quoted
+        
+    def params(self, operation, operation_params):
+        ''' the sorted list of "Name=value" request parameters, everything but the Timestamp and Signature '''
+        
+        quote = self.quote
+        dynamic = ["Operation=" + operation]
+        for (operation_param, operation_value) in operation_params.items():
+            if operation_value is not None:
+                dynamic.append("%s=%s" % (operation_param, quote(operation_value)))
+                
+        # sort by byte value - not alphabetical
+        dynamic.extend(self.static_params)
+        dynamic.sort()
+        return dynamic
+        
+    def timestamp_param(self):
+        ''' "Timestamp=..." for now, in GMT.  only formatted once a second. '''
+        
+        now = int(time.time())
+        (second, param) = self.last_timestamp
+        if second != now:
+            timestamp = time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(now))
+            param = "Timestamp=" + urllib.quote(timestamp)
+            self.last_timestamp = (now, param)
+        return param
+        
+    def sign(self, param_string):
+        ''' url-quoted base64 HMAC-SHA256 signature of the request '''
+        
+        # HMAC by hand: outer(inner(message)), with both already keyed
+        inner = self.inner.copy()
+        inner.update(param_string)
+        outer = self.outer.copy()
+        outer.update(inner.digest())
+        return urllib.quote(base64.b64encode(outer.digest()))
+        
+    def url(self, operation, operation_params):
+        ''' signed request url '''
+        
+        params = self.params(operation, operation_params)
+        bisect.insort(params, self.timestamp_param())
+        
+        param_string = "&".join(params)
+        return self.url_prefix + param_string + "&Signature=" + self.sign(param_string)
+        
         
 class ProductAdvertisingAPI(object):
 
+    # locale -> endpoint host
     locale = {
         "US": "ecs.amazonaws.com",
+        "UK": "ecs.amazonaws.co.uk",
+        "DE": "ecs.amazonaws.de",
+        "JP": "ecs.amazonaws.jp",
+        "CA": "ecs.amazonaws.ca",
+        "FR": "ecs.amazonaws.fr",
     }
     
-    def __init__(self, aws_key=None, aws_secret=None, associate_tag=None, locale="US", api_version="2011-08-01", printurl=False):
+    def __init__(self, aws_key=None, aws_secret=None, associate_tag=None, locale="US", api_version="2011-08-01", printurl=False,
+                 pool=None, cache=None, scheduler=None, priority=throttle.INTERACTIVE, metrics=None,
+                 diagnostics_level=logging.DEBUG, diagnostics_sample=0.0, max_body_size=net.MAX_BODY_SIZE, singleflight=None,
+                 host=None, policy=None):
+        ''' printurl - log each request's url.  (at WARNING: paa doesn't set the amazon logger to INFO at import any more)
+            pool - net.ConnectionPool to fetch on, the shared net.default_pool if None. 
+            cache - cache.ResponseCache to keep responses in, or None to always fetch.
+            scheduler - throttle.RequestScheduler to rate limit requests with, or None to send them right away.
+            priority - this client's place in the scheduler's queue.  (throttle.INTERACTIVE or throttle.BATCH)
+            metrics - metrics.MemoryMetrics (or anything with enabled and record()) to time each phase of a request
+                      with, or None for no timing.
+            diagnostics_level - level to log a summary of each response's items at (see Diagnostics).
+            diagnostics_sample - fraction of converted products to log in full at diagnostics_level.
+            max_body_size - largest response (in bytes, decompressed) to accept, None for no limit.
+            singleflight - singleflight.SingleFlight to coalesce identical concurrent lookups and searches with, so 
+                           they share one request and response.  None to always make the request.
+            host - "host[:port]" to send requests to instead of the locale's endpoint.  (e.x. a mockserver)
+            policy - net.ResiliencePolicy to retry, circuit break and hedge requests under, or None to send each once.
+                     (retries aren't rate limited by scheduler, it only sees the request as a whole)
+        '''
         
         if aws_key is None:
             self.aws_key = AWS_KEY
@@ -134,13 +646,34 @@ class ProductAdvertisingAPI(object):
         else:
             self.associate_tag = associate_tag
             
-        self.locale_host = self.locale[locale]
+        if locale not in self.locale:
+            raise Exception("Unknown locale %s, expected one of %s" % (locale, ", ".join(sorted(self.locale))))
+        if host is None:
+            self.locale_host = self.locale[locale]
+        else:
+            self.locale_host = host
         self.printurl = printurl
+        self.pool = pool
+        self.cache = cache
+        self.scheduler = scheduler
+        self.priority = priority
+        if metrics is None:
+            self.metrics = NULL_METRICS
+        else:
+            self.metrics = metrics
+        self.diagnostics_level = diagnostics_level
+        self.diagnostics_sample = diagnostics_sample
+        self.max_body_size = max_body_size
+        self.singleflight = singleflight
+        self.policy = policy
 
         self.locale_url = "http://%s/onca/xml" % self.locale_host
         
         self.api_version = api_version
         self.xmlns = "http://webservices.amazon.com/AWSECommerceService/%s" % self.api_version
+        self.names = xml_names(self.xmlns)
+        
+        self.signer = RequestSigner(self.locale_host, self.aws_key, self.aws_secret, self.associate_tag, self.api_version)
         
 
     def browse_node_lookup(self, browse_node_id, response_group="BrowseNodeInfo"):
@@ -149,38 +682,42 @@ class ProductAdvertisingAPI(object):
             Top-level browse nodes are documented here: http://docs.amazonwebservices.com/AWSECommerceService/latest/DG/index.html?BrowseNodeIDs.html
         '''
         
-        response = BrowseNodeLookupResponse()
+        params = dict(BrowseNodeId=str(browse_node_id), ResponseGroup=response_group)
         
-        etree = self.fetchxml("BrowseNodeLookup", BrowseNodeId=str(browse_node_id), ResponseGroup=response_group)
+        def lookup():
+            etree = self.fetchxml("BrowseNodeLookup", **params)
                               
-        # convert element tree to an ItemSearchResponse object
-        root = etree.getroot()
+            # convert element tree to a BrowseNodeLookupResponse object
+            root = etree.getroot()
+            return self.timed_convert("BrowseNodeLookup", self.convert_browse_node_lookup_response, root)
+            
+        return self.coalesced("BrowseNodeLookup", params, lookup)
         
-        xpath = "%s/%s" % (self.qname("OperationRequest"), self.qname("RequestId"))
-        request_id = root.find(xpath)
+    def convert_browse_node_lookup_response(self, root):
+        ''' scrape the interesting bits out of an element tree browse node lookup response.  return a BrowseNodeLookupResponse object '''
+        
+        response = BrowseNodeLookupResponse()
+        
+        names = self.names
+        
+        request_id = root.find(names.request_id_path)
         response.request_id = request_id.text    # Amazon's unique id for this request.  (probably handy for tracking.)
         
-        xpath = str(self.qname("BrowseNodes"))
-        browse_nodes = root.find(xpath)
+        browse_nodes = root.find(names.BrowseNodes)
 
-        xpath = "%s/%s" % (self.qname("Request"), self.qname("IsValid"))
-        isvalid = browse_nodes.find(xpath)
+        isvalid = browse_nodes.find(names.isvalid_path)
         response.is_valid = self.str2bool(isvalid.text)
 
-        xpath = str(self.qname("BrowseNode"))
-        browse_node = browse_nodes.find(xpath)
+        browse_node = browse_nodes.find(names.BrowseNode)
         
         def parse_browse_node(element):
-            xpath = str(self.qname("BrowseNodeId"))
-            node_id = element.find(xpath)
+            node_id = element.find(names.BrowseNodeId)
             node_id = int(node_id.text)
         
-            xpath = str(self.qname("Name"))
-            name = element.find(xpath)
+            name = element.find(names.Name)
             name = name.text
         
-            xpath = str(self.qname("IsCategoryRoot"))
-            category_root = element.find(xpath)
+            category_root = element.find(names.IsCategoryRoot)
             if category_root is not None:
                 category_root = self.str2bool(category_root.text)
                 
@@ -194,8 +731,7 @@ class ProductAdvertisingAPI(object):
         response.node = parse_browse_node(browse_node)
         
         # do ancestors list, ignore ancestors of ancestors:
-        xpath = str(self.qname("Ancestors"))
-        ancestors = browse_node.find(xpath)
+        ancestors = browse_node.find(names.Ancestors)
         
         if ancestors is not None:
             # top nodes have no ancestors.
@@ -204,42 +740,52 @@ class ProductAdvertisingAPI(object):
                 response.ancestors.append(node)
             
         # do children list:
-        xpath = str(self.qname("Children"))
-        children = browse_node.find(xpath)
+        children = browse_node.find(names.Children)
         
-        for bn in children:
-            node = parse_browse_node(bn)
-            response.children.append(node)
+        if children is not None:
+            # leaf nodes have no children.
+            for bn in children:
+                node = parse_browse_node(bn)
+                response.children.append(node)
 
 
         return response
         
-    def convert_item_lookup_response(self, root):
-        ''' scrape the interesting bits out of an element tree item lookup response.  return an ItemLookupResponse object '''
+    def convert_item_lookup_response(self, root, stream=False, fields=None, lazy=False):
+        ''' scrape the interesting bits out of an element tree item lookup response.  return an ItemLookupResponse object 
+        
+            stream - if True, root is a file-like object holding the response document and it is converted with iterparse
+                     rather than a full element tree build.
+            fields, lazy - see convert_items.
+        '''
         
         response = ItemLookupResponse()
+        
+        if stream:
+            products = list(self.iterparse_items(root, response, fields=fields, lazy=lazy))
+            if len(products) != 1:
+                raise Exception("ItemLookup returned unexpected number of products (%d).  Expected 1" % len(products))
+                
+            response.product = products[0]
+            return response
+
+        names = self.names
 
-        xpath = "%s/%s" % (self.qname("OperationRequest"), self.qname("RequestId"))
-        request_id = root.find(xpath)
+        request_id = root.find(names.request_id_path)
         response.request_id = request_id.text    # Amazon's unique id for this request.  (probably handy for tracking.)
             
         #logger.info("Amazon request id: %s" % request_id)
         
-        xpath = str(self.qname("Items"))
-        items = root.find(xpath)
+        items = root.find(names.Items)
         
-        xpath = "%s/%s" % (self.qname("Request"), self.qname("IsValid"))
-        isvalid = items.find(xpath)
+        isvalid = items.find(names.isvalid_path)
         response.is_valid = self.str2bool(isvalid.text)
         
         if not response.is_valid:
             raise Exception("Request not valid!")
 
-        xpath = str(self.qname("Items"))
-        items = root.find(xpath)
-        
         # "Items" part of the document seems exactly the same as in Item Search responses:
-        products = self.convert_items(items)
+        products = self.convert_items(items, fields=fields, lazy=lazy)
         
         # should be 1 product in the response
         if len(products) != 1:
@@ -249,202 +795,342 @@ class ProductAdvertisingAPI(object):
         
         return response
         
-    def convert_item_search_response(self, root):
-        ''' scrape the interesting bits out of an element tree item search response.  return an ItemSearchResponse object '''
+    def convert_item_lookup_batch_response(self, root, asins):
+        ''' scrape a multi-ASIN item lookup response.  
+        
+            Returns a list of workers.Result, one per asin in the same order.  result.value is an ItemLookupResponse for 
+            that ASIN, or result.error says why it wasn't in the response.  (invalid ASINs don't fail the whole batch)
+        '''
+        
+        names = self.names
+        
+        request_id = root.find(names.request_id_path).text
+        
+        items = root.find(names.Items)
+        
+        isvalid = items.find(names.isvalid_path)
+        is_valid = self.str2bool(isvalid.text)
+        
+        if not is_valid:
+            raise Exception("Request not valid!")
+            
+        # amazon reports each bad ItemId as an error like "B00XXXXXXX is not a valid value for ItemId. ..."
+        messages = []
+        for error in items.findall(names.errors_path):
+            messages.append("%s: %s" % (error.find(names.Code).text, error.find(names.Message).text))
+        
+        products = {}
+        for product in self.convert_items(items):
+            products[product.asin] = product
+            
+        results = []
+        for asin in asins:
+            result = workers.Result(asin)
+            
+            product = products.get(asin)
+            if product is None:
+                reasons = [m for m in messages if asin in m] or ["not in response"]
+                result.error = Exception("ItemLookup found no product for ASIN %s (%s)" % (asin, "; ".join(reasons)))
+            else:
+                response = ItemLookupResponse()
+                response.request_id = request_id
+                response.is_valid = is_valid
+                response.product = product
+                result.value = response
+                
+            results.append(result)
+            
+        return results
+        
+    def convert_item_search_response(self, root, stream=False, batch=None, fields=None, lazy=False):
+        ''' scrape the interesting bits out of an element tree item search response.  return an ItemSearchResponse object 
+        
+            stream - if True, root is a file-like object holding the response document.  The response header fields are
+                     filled in right away and response.products is a generator that yields each Product as its Item
+                     element is parsed, so peak memory is one Item rather than the whole page.  root is closed once the
+                     generator is exhausted or closed, so close() it to stop early and let go of the connection.
+            batch - a ProductBatch to add the products to (see convert_items).  response.products is the batch.
+            fields, lazy - see convert_items.
+        '''
 
         response = ItemSearchResponse()
         
-        xpath = "%s/%s" % (self.qname("OperationRequest"), self.qname("RequestId"))
-        request_id = root.find(xpath)
+        if stream:
+            response.products = self.iterparse_items(root, response, fields=fields, lazy=lazy)
+            return response
+        
+        names = self.names
+        
+        request_id = root.find(names.request_id_path)
         
         response.request_id = request_id.text    # Amazon's unique id for this request.  (probably handy for tracking.)
             
         #logger.info("Amazon request id: %s" % request_id)
         
-        xpath = str(self.qname("Items"))
-        items = root.find(xpath)
+        items = root.find(names.Items)
         
-        xpath = "%s/%s" % (self.qname("Request"), self.qname("IsValid"))
-        isvalid = items.find(xpath)
+        isvalid = items.find(names.isvalid_path)
         response.is_valid = self.str2bool(isvalid.text)
         
         if not response.is_valid:
             raise Exception("Request not valid!")
         
-        xpath = str(self.qname("TotalResults"))
-        num_results = items.find(xpath)
+        num_results = items.find(names.TotalResults)
         response.num_results = int(num_results.text)
         
-        xpath = str(self.qname("TotalPages"))
-        num_pages = items.find(xpath)
+        num_pages = items.find(names.TotalPages)
         response.num_pages = int(num_pages.text)
 
         # process list of items
-        products = self.convert_items(items)
+        products = self.convert_items(items, batch=batch, fields=fields, lazy=lazy)
         response.products = products
         
         return response
         
-    def convert_items(self, items):
-        ''' Process a list of items from an ItemLookup or ItemSearch response.  return a list of Product objects '''
+    def convert_items(self, items, batch=None, fields=None, lazy=False):
+        ''' Process a list of items from an ItemLookup or ItemSearch response.  return a list of Product objects 
         
-        products = []
+            batch - if given, a ProductBatch to append each item to instead.  no Product is kept per item.  returns the batch.
+            fields - Product field names to scrape, None for all of them.  the rest are left empty.
+            lazy - if True, return LazyProducts, which only scrape a field when it's first read.
+        '''
         
-        xpath = str(self.qname("Item"))
-        item_list = items.findall(xpath)
-        for item in item_list:
+        names = self.names.project(fields)
+        item_list = items.findall(names.Item)
+        
+        if batch is not None:
+            # every item is scraped into the same scratch Product and copied into the batch's columns:
+            diagnostics = self.diagnostics()
             product = Product()
+            for item in item_list:
+                product.clear()
+                batch.append(self.convert_item(item, product, names, diagnostics))
+                
+            if diagnostics is not None:
+                diagnostics.log("batch")
+            return batch
             
-            # NOTE: all 'text' strings in the parsed XML that need to be utf-8 decode are already unicode strings because python tries to be super smart about which type
-            # of string to construct.  Do no further utf-8 decoding here!
+        if lazy:
+            return [LazyProduct(item, names) for item in item_list]
+        
+        diagnostics = self.diagnostics()
+        products = []
+        
+        for item in item_list:
+            product = self.convert_item(item, names=names, diagnostics=diagnostics)
+            products.append(product)
             
-            xpath = str(self.qname("ASIN"))
-            product.asin = item.find(xpath).text
-
-            xpath = str(self.qname("DetailPageURL"))
-            product.detail_url = item.find(xpath).text
+        if diagnostics is not None:
+            diagnostics.log("products")
+        return products
+        
+    def diagnostics(self):
+        ''' a Diagnostics to check one response's items with, or None if it wouldn't be logged '''
         
-            xpath = str(self.qname("SalesRank"))
-            rank = item.find(xpath)
-            if rank is not None:
-                product.sales_rank = rank.text
+        if logger.isEnabledFor(self.diagnostics_level):
+            return Diagnostics(self.diagnostics_level, self.diagnostics_sample)
+        return None
 
-            # stuff like actor, product group, etc is in the item attributes block
-            xpath = str(self.qname("ItemAttributes"))
-            item_attributes = item.find(xpath)
+    def iterparse_items(self, source, response, fields=None, lazy=False):
+        ''' Incrementally parse an ItemSearch or ItemLookup response document from the file-like object source.
+        
+            Header fields (request id, validity, result and page counts) are copied onto response as they are parsed, 
+            everything up to the first Item is consumed before this returns.  Returns a generator of Product objects, 
+            each Item element is cleared and detached from the tree once it has been converted.  (with lazy, see 
+            convert_items, each LazyProduct keeps its own Item instead)
             
-            # check for 1 or more actors:
-            xpath = str(self.qname("Actor"))
-            actors = item_attributes.findall(xpath)
-            for a in actors:
-                product.actors.append(a.text)
-
-            # check for 1 or more artists:
-            xpath = str(self.qname("Artist"))
-            artists = item_attributes.findall(xpath)
-            for a in artists:
-                product.artists.append(a.text)
-                
-            # mp3 downloads appear to have a Creator field instead of an artist.  if we didn't find an artist, check for creator:
-            if len(product.artists) == 0:
-                xpath = str(self.qname("Creator"))
-                creator = item_attributes.find(xpath)
-                if creator is not None:
-                    product.artists.append(creator.text)
-            
-            xpath = str(self.qname("ProductGroup"))
-            product.category = item_attributes.find(xpath).text
-            
-            xpath = str(self.qname("Title"))
-            product.title = item_attributes.find(xpath).text
-            
-            # i think this is only available for books:
-            xpath = str(self.qname("Author"))
-            auth = item_attributes.find(xpath)
-            if auth is not None:
-                product.author = auth.text
-
-            # get pricing information from OfferSummary group:
-            xpath = str(self.qname("OfferSummary"))
-            offer_summary = item.find(xpath)
-            
-            # no offer summary response group for Kindle books (others too, perhaps?)
-            if offer_summary is None:
-                logger.info("No offer summary for ASIN %s (%s)" % (product.asin, product.title))
-            else:
-                xpath = str(self.qname("LowestNewPrice"))
-                lowest_new_price = offer_summary.find(xpath)
+            source is closed when the generator finishes or is closed, or right away if there are no items or parsing 
+            the header fails.
+        '''
+        
+        names = self.names
+        items_tag = names.Items
+        item_tag = names.Item
+        request_id_tag = names.RequestId
+        isvalid_tag = names.IsValid
+        num_results_tag = names.TotalResults
+        num_pages_tag = names.TotalPages
+        
+        items = None
+        first_item = False
+        
+        try:
+            events = ET.iterparse(source, events=("start", "end"))
+            
+            for (event, element) in events:
+                tag = element.tag
                 
-                if lowest_new_price is None:
-                    logger.info("No lowest new price for ASIN %s (%s)" % (product.asin, product.title))
-                else:
-                    xpath = str(self.qname("Amount"))
-                    amt = lowest_new_price.find(xpath)
-                   
-                    if amt is None:
-                        logger.info("Lowest new price has NO Amount field for asin %s" % product.asin)
+                if event == "start":
+                    if tag == items_tag:
+                        items = element
+                    elif tag == item_tag:
+                        first_item = True
+                        break
                         
-                    else:
-                        # the Amount field is given as "1699", meaning $16.99
-                        product.lowest_new_price = int(amt.text) / 100.0
+                elif tag == request_id_tag:
+                    response.request_id = element.text
+                elif tag == isvalid_tag:
+                    response.is_valid = self.str2bool(element.text)
+                elif tag == num_results_tag:
+                    response.num_results = int(element.text)
+                elif tag == num_pages_tag:
+                    response.num_pages = int(element.text)
+                    
+            if not response.is_valid:
+                raise Exception("Request not valid!")
+                
+        except:
+            source.close()
+            raise
             
-            # some item results do not have small/med/large images.  (they may have ImageSets)
-            xpath = "%s/%s" % (self.qname("SmallImage"), self.qname("URL"))
-            image = item.find(xpath)
-            if image is not None:
-                product.small_image_url = image.text
-
-            xpath = "%s/%s" % (self.qname("MediumImage"), self.qname("URL"))
-            image = item.find(xpath)
-            if image is not None:
-                product.medium_image_url = image.text
-
-            xpath = "%s/%s" % (self.qname("LargeImage"), self.qname("URL"))
-            image = item.find(xpath)
-            if image is not None:
-                product.large_image_url = image.text
-
-            logger.info(product)
-
-            products.append(product)
+        if not first_item:
+            # no items on this page
+            source.close()
+            return iter([])
             
-        logger.info("Converted %d items to products" % len(products))
-        return products
+        return self._iterparse_items(source, events, items, item_tag, names.project(fields), lazy)
+        
+    def _iterparse_items(self, source, events, items, item_tag, names, lazy):
+        ''' generator half of iterparse_items.  the start event of the first Item has already been consumed.  source is 
+            closed when the generator finishes or is closed.
+        '''
+        
+        try:
+            # Items can nest other Items (e.x. the Variations response group) so only convert the top level ones:
+            depth = 1
+            diagnostics = None
+            if not lazy:
+                diagnostics = self.diagnostics()
+            
+            for (event, element) in events:
+                if element.tag != item_tag:
+                    continue
+                    
+                if event == "start":
+                    depth += 1
+                    continue
+                    
+                depth -= 1
+                if depth == 0:
+                    if lazy:
+                        product = LazyProduct(element, names)
+                    else:
+                        product = self.convert_item(element, names=names, diagnostics=diagnostics)
+                        element.clear()
+                    
+                    # drop the converted element so the tree never holds more than one Item:
+                    items.remove(element)
+                    
+                    yield product
+                    
+            if diagnostics is not None:
+                diagnostics.log("products")
+                
+        finally:
+            source.close()
 
+    def convert_item(self, item, product=None, names=None, diagnostics=None):
+        ''' Process a single Item element from an ItemLookup or ItemSearch response.  return a Product object 
         
-    def construct_url(self, operation, operation_params):
-        ''' construct aws url '''
+            product - an empty Product to fill in, or None for a new one.
+            names - XMLNames to scrape with, a projection (see XMLNames.project) to only fill in some fields.
+            diagnostics - Diagnostics to count anything missing from the item in, or None.
+        '''
         
-        # need a sorted list of all request parameters so we can generate a signature.
-        params = [
-            "Service=AWSECommerceService",
-            "Operation=" + operation,
-            "AWSAccessKeyId=" + self.aws_key,
-        ]
+        if product is None:
+            product = Product()
         
-        if self.associate_tag:
-            params.append("AssociateTag=" + self.associate_tag)
+        # NOTE: all 'text' strings in the parsed XML that need to be utf-8 decode are already unicode strings because python tries to be super smart about which type
+        # of string to construct.  Do no further utf-8 decoding here!
         
-        for (operation_param, operation_value) in operation_params.items():
-            
-            if operation_value is not None:
-                p = "%s=%s" % (operation_param, urllib.quote(operation_value))
-                params.append(p)
-
+        if names is None:
+            names = self.names
+        handlers = names.item_handlers
+        
+        # one pass over the item's children, dispatching on tag:
+        for child in item:
+            handler = handlers.get(child.tag)
+            if handler is not None:
+                handler(names, product, child)
+                
+        if diagnostics is not None:
+            diagnostics.check(names, item, product)
 
-        params.append("Version=" + self.api_version)
+        return product
 
-        # just for debug, generate "unsigned url" to test with their signature helper:
-        # http://associates-amazon.s3.amazonaws.com/signed-requests/helper/index.html
-        #print self.locale_url + "?" + "&".join(params)
         
-        timestamp = self.timestamp()
-        params.append("Timestamp=" + urllib.quote(timestamp))
-
-        # sort by byte value - not alphabetical
-        params = sorted(params)
+    def request_params(self, operation, operation_params):
+        ''' the sorted list of "Name=value" request parameters, everything but the Timestamp and Signature '''
+        return self.signer.params(operation, operation_params)
         
-        # join params by ampersand (&) for signing:
-        param_string = "&".join(params)
+    def request_key(self, operation, operation_params):
+        ''' canonical string for a request: the same for every request with the same host and parameters, whatever time it's made '''
+        
+        params = self.request_params(operation, operation_params)
+        return self.locale_host + "?" + "&".join(params)
+        
+    def construct_url(self, operation, operation_params):
+        ''' construct aws url 
         
-        # generate hmac signature:
-        signature = self.sign(param_string)
-        param_string += "&Signature=" + signature
+            just for debug, "&".join(self.request_params(...)) is the "unsigned url" to test with their signature helper:
+            http://associates-amazon.s3.amazonaws.com/signed-requests/helper/index.html
+        '''
         
-        url = self.locale_url + "?" + param_string
-        return url
+        return self.signer.url(operation, operation_params)
 
     def fetch(self, operation, operation_params):
         ''' fetch document, return file-like object as response '''
         
+        if self.cache is not None:
+            key = self.request_key(operation, operation_params)
+            body = self.cache.get(key)
+            if body is not None:
+                return StringIO(body)
+        
+        if self.scheduler is None:
+            f = self.send(operation, operation_params)
+        else:
+            # wait our turn.  (the url is built once we have it so its Timestamp is current, even on a retry)
+            f = self.scheduler.run(self.aws_key, lambda: self.send(operation, operation_params), self.priority)
+        
+        if self.cache is not None:
+            try:
+                body = f.read()
+            finally:
+                f.close()
+            self.cache.put(key, operation, body)
+            f = StringIO(body)
+            
+        return f
+        
+    def send(self, operation, operation_params):
+        ''' Sign and send a request, return file-like object as response.
+        
+            The response body is read off the connection as the file is read, so close it if it isn't read to the end.
+        '''
+        
+        metrics = self.metrics
+        if metrics.enabled:
+            start = time.time()
+        
         url = self.construct_url(operation, operation_params)
         
+        if metrics.enabled:
+            signed = time.time()
+            metrics.record(operation, "sign", signed - start)
+        
         if self.printurl:
-            logger.info(url)
+            # (at WARNING, so it shows without setting the amazon logger's level)
+            logger.warning(url)
 
         # Google App Engine supports Python 2.7 as of release 1.6.0.  However, there is an outstanding bug (#6271) in their standard library facade over the urlfetch
         # service, so use urlfetch directly if we're on GAE.
-        f = net.get(url)
+        f = net.get(url, pool=self.pool, stream=True, max_body_size=self.max_body_size, policy=self.policy)
+        
+        if metrics.enabled:
+            # (only up to the response headers, the body is read as it's parsed)
+            metrics.record(operation, "network", time.time() - signed)
+            
         return f
         
     def fetchxml(self, operation, **operation_params):
@@ -452,20 +1138,49 @@ class ProductAdvertisingAPI(object):
         
         f = self.fetch(operation, operation_params)
         
+        if self.metrics.enabled:
+            start = time.time()
+        
         # be very careful when parsing elements to preserve their unicode-ness
-        etree = ET.parse(f)
+        try:
+            etree = ET.parse(f)
+            size = f.tell()
+        finally:
+            f.close()
+        
+        if self.metrics.enabled:
+            self.metrics.record(operation, "parse", time.time() - start)
+            self.metrics.record(operation, "bytes", size)
+            
         return etree
         
+    def timed_convert(self, operation, convert, *args, **kwargs):
+        ''' convert(*args, **kwargs), recording how long it took and how many items came out of it if metrics are enabled '''
+        
+        if not self.metrics.enabled:
+            return convert(*args, **kwargs)
+            
+        start = time.time()
+        response = convert(*args, **kwargs)
+        self.metrics.record(operation, "convert", time.time() - start)
+        
+        if isinstance(response, ItemSearchResponse):
+            self.metrics.record(operation, "items", len(response.products))
+        elif isinstance(response, ItemLookupResponse):
+            self.metrics.record(operation, "items", int(response.product is not None))
+        elif isinstance(response, list):
+            # item_lookup_batch's Results
+            self.metrics.record(operation, "items", len([r for r in response if r.ok()]))
+            
+        return response
+        
     def sign(self, param_string):
         ''' Calculate an RFC 2104-compliant HMAC with the SHA256 hash algorithm
             (as per http://docs.amazonwebservices.com/AWSECommerceService/2010-11-01/DG/)
         '''
         
-        # prepend some magic poop:
-        s = "GET\n%s\n/onca/xml\n%s" % (self.locale_host, param_string)
-        
-        signature = self.sign_with_key(self.aws_secret, s)
-        return signature
+        # the signer has the magic poop prepended and the key already in its hmac:
+        return self.signer.sign(param_string)
         
     def sign_with_key(self, key, msg):
         
@@ -489,28 +1204,150 @@ class ProductAdvertisingAPI(object):
         t = time.gmtime() # time tuple in gmt zone
         return time.strftime("%Y-%m-%dT%H:%M:%S.000Z", t)
 
-    def item_lookup(self, asin, response_group="Medium"):
-        ''' Do amazon item lookup operation '''
+    def item_lookup(self, asin, response_group="Medium", stream=False, fields=None, lazy=False):
+        ''' Do amazon item lookup operation 
         
-        etree = self.fetchxml("ItemLookup", ItemId=asin, Condition="All", ResponseGroup=response_group)
+            fields - Product field names to scrape, None for all of them.  (e.x. ("asin", "title", "lowest_new_price"))
+            lazy - if True, the product is a LazyProduct that only scrapes a field when it's first read.
+        '''
+        
+        params = dict(ItemId=asin, Condition="All", ResponseGroup=response_group)
+        
+        if stream:
+            f = self.fetch("ItemLookup", params)
+            return self.convert_item_lookup_response(f, stream=True, fields=fields, lazy=lazy)
+            
+        def lookup():
+            etree = self.fetchxml("ItemLookup", **params)
         
-        # convert element tree to an ItemSearchResponse object
-        root = etree.getroot()
-        return self.convert_item_lookup_response(root)
+            # convert element tree to an ItemSearchResponse object
+            root = etree.getroot()
+            return self.timed_convert("ItemLookup", self.convert_item_lookup_response, root, fields=fields, lazy=lazy)
+            
+        return self.coalesced("ItemLookup", params, lookup, fields, lazy)
         
 
-    def item_search(self, keywords=None, browse_node=None, search_index="All", response_group="Medium", title=None):
-        ''' Medium response group provides basic information and also gives includes the URLs for product images. '''
+    def item_search(self, keywords=None, browse_node=None, search_index="All", response_group="Medium", title=None, stream=False,
+                    page=None, fields=None, lazy=False):
+        ''' Medium response group provides basic information and also gives includes the URLs for product images. 
+        
+            stream - if True, the products of the returned response are yielded as the document is parsed.
+            page - result page to fetch (ItemPage), the first page if None.
+            fields - Product field names to scrape, None for all of them.  (e.x. ("asin", "title", "lowest_new_price"))
+            lazy - if True, the products are LazyProducts that only scrape a field when it's first read.
+        '''
         
         # search across all indices for available items.  
         
-        etree = self.fetchxml("ItemSearch", BrowseNode=browse_node, SearchIndex=search_index, Condition="All", 
-                              ResponseGroup=response_group, Keywords=keywords, Title=title)
+        params = self.item_search_params(keywords, browse_node, search_index, response_group, title, page)
+        
+        if stream:
+            f = self.fetch("ItemSearch", params)
+            return self.convert_item_search_response(f, stream=True, fields=fields, lazy=lazy)
+            
+        def search():
+            etree = self.fetchxml("ItemSearch", **params)
                               
-        # convert element tree to an ItemSearchResponse object
-        root = etree.getroot()
-        return self.convert_item_search_response(root)
+            # convert element tree to an ItemSearchResponse object
+            root = etree.getroot()
+            return self.timed_convert("ItemSearch", self.convert_item_search_response, root, fields=fields, lazy=lazy)
+            
+        return self.coalesced("ItemSearch", params, search, fields, lazy)
+        
+    def coalesced(self, operation, operation_params, func, fields=None, lazy=False):
+        ''' func(), or with a singleflight, the result of an identical call already in flight if there is one '''
+        
+        if self.singleflight is None:
+            return func()
+            
+        if fields is not None:
+            fields = frozenset(fields)
+        key = (self.request_key(operation, operation_params), fields, lazy)
+        return self.singleflight.do(key, func)
+
+    def item_search_params(self, keywords=None, browse_node=None, search_index="All", response_group="Medium", title=None,
+                           page=None):
+        ''' the ItemSearch operation params for item_search's arguments '''
+        
+        if page is not None:
+            page = str(page)
+            
+        return dict(BrowseNode=browse_node, SearchIndex=search_index, Condition="All", ResponseGroup=response_group, 
+                    Keywords=keywords, Title=title, ItemPage=page)
 
+    def item_lookup_batch(self, asins, response_group="Medium", max_workers=1):
+        ''' Look up asins MAX_LOOKUP_ITEMS at a time, using ItemLookup's comma separated ItemId list.
+        
+            Returns a list of workers.Result in the same order as asins, see convert_item_lookup_batch_response.  If a 
+            whole request fails each of its ASINs gets that error.  max_workers limits how many requests are in flight.
+        '''
+        
+        asins = list(asins)
+        chunks = [asins[i:i + MAX_LOOKUP_ITEMS] for i in xrange(0, len(asins), MAX_LOOKUP_ITEMS)]
+        
+        def lookup(chunk):
+            etree = self.fetchxml("ItemLookup", ItemId=",".join(chunk), Condition="All", ResponseGroup=response_group)
+            return self.timed_convert("ItemLookup", self.convert_item_lookup_batch_response, etree.getroot(), chunk)
+            
+        results = []
+        for chunk_result in workers.pmap(lookup, chunks, max_workers=max_workers):
+            if chunk_result.ok():
+                results.extend(chunk_result.value)
+            else:
+                for asin in chunk_result.arg:
+                    result = workers.Result(asin)
+                    result.error = chunk_result.error
+                    results.append(result)
+                    
+        return results
+        
+    def item_lookup_many(self, asins, response_group="Medium", max_workers=4):
+        ''' Look up each of asins, with at most max_workers requests in flight.
+        
+            Returns a list of workers.Result in the same order as asins.  result.value is the ItemLookupResponse, or
+            result.error is the exception if that lookup failed.
+        '''
+        
+        def lookup(asin):
+            return self.item_lookup(asin, response_group=response_group)
+            
+        return workers.pmap(lookup, asins, max_workers=max_workers)
+        
+    def item_search_pages(self, keywords=None, pages=range(1, 6), max_workers=4, **search_params):
+        ''' Fetch several pages of the same item search, with at most max_workers requests in flight.
+        
+            search_params are passed through to item_search.  Returns a list of workers.Result in the same order as 
+            pages.  result.value is the ItemSearchResponse for that page, or result.error is the exception if it failed.
+        '''
+        
+        def search(page):
+            return self.item_search(keywords=keywords, page=page, **search_params)
+            
+        return workers.pmap(search, pages, max_workers=max_workers)
+        
+    def iter_search_results(self, keywords=None, lookahead=1, max_pages=10, **search_params):
+        ''' Yield every Product of an item search, page after page.
+        
+            While the caller works through one page the next lookahead pages are already being fetched.  At most 
+            max_pages pages are fetched.  (amazon won't go past page 10 anyway, or page 5 when searching All.)  
+            search_params are passed through to item_search.  A failed page raises its error once it's reached.
+        '''
+        
+        first = self.item_search(keywords=keywords, page=1, **search_params)
+        num_pages = min(first.num_pages, max_pages)
+        
+        def search(page):
+            return self.item_search(keywords=keywords, page=page, **search_params)
+            
+        # get the next pages started before handing out the first one:
+        pages = workers.Prefetcher(search, xrange(2, num_pages + 1), depth=lookahead)
+        
+        for product in first.products:
+            yield product
+            
+        for result in pages:
+            for product in result.get().products:
+                yield product
         
     def item_search_async_google(self, keywords, search_index="All", response_group="Medium", page=1, deadline=5):
         ''' Start an asynchronous request with Google App Engine's urlfetch service.
@@ -527,7 +1364,8 @@ class ProductAdvertisingAPI(object):
         url = self.construct_url("ItemSearch", operation_params)
         
         if self.printurl:
-            logger.info(url)
+            # (at WARNING, so it shows without setting the amazon logger's level)
+            logger.warning(url)
 
         from google.appengine.api import urlfetch
         rpc = urlfetch.create_rpc(deadline=deadline, callback=None)
@@ -539,25 +1377,36 @@ class ProductAdvertisingAPI(object):
         
         
     def qname(self, element_name):
+        ''' build a QName for this api version's namespace.  (the scrapers use the prebuilt self.names instead) '''
         return ET.QName(self.xmlns, element_name)
         
         
-    def xml_string_to_item_search_response(self, xml):
-        ''' Take a full ItemSearchResponse XML document as a string and convert it to a usable object '''    
+    def xml_string_to_item_search_response(self, xml, stream=False, fields=None, lazy=False):
+        ''' Take a full ItemSearchResponse XML document as a string and convert it to a usable object 
+        
+            stream - if True, response.products is a generator of Product objects.  (see convert_item_search_response)
+            fields, lazy - see convert_items.
+        '''    
+        
+        if stream:
+            return self.convert_item_search_response(StringIO(xml), stream=True, fields=fields, lazy=lazy)
         
         root = ET.fromstring(xml) # returns the root element as an element tree Element object.
-        return self.convert_item_search_response(root)
+        return self.convert_item_search_response(root, fields=fields, lazy=lazy)
         
     
 if __name__=='__main__':
     logging.basicConfig()
+    logger.setLevel(logging.INFO)
     
     parser = OptionParser()
     parser.add_option("-u", "--printurl", dest="printurl", help="Print AWS request URL", metavar="PRINTURL", 
                       default=False, action="store_true")
     (options, args) = parser.parse_args()
                       
-    api = ProductAdvertisingAPI(AWS_KEY, AWS_SECRET, printurl=options.printurl)
+    # log every product converted:
+    api = ProductAdvertisingAPI(AWS_KEY, AWS_SECRET, printurl=options.printurl, diagnostics_level=logging.INFO, 
+                                diagnostics_sample=1.0)
     
     #response = api.item_search("a few good men")
     #response = api.item_search(args[0])
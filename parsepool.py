@@ -0,0 +1,142 @@
+''' Parse item search responses in a pool of processes.
+
+    Building the element tree and converting items is CPU bound and holds the GIL, so once a bulk job is parsing more
+    than it's waiting on amazon more threads don't help.  ParsePool hands the raw response bodies to worker processes,
+    a batch at a time to keep the pickling down, and gets back compact Product records (plain tuples) to rebuild
+    Products from:
+
+        parser = ParsePool(processes=4)
+        for result in parser.item_search_pages(api, keywords="stumbling*", search_index="Books", pages=range(1, 11)):
+            print result.value.num_results
+        parser.close()
+'''
+
+import logging
+logger = logging.getLogger("amazon")
+import multiprocessing
+
+import paa
+import workers
+
+FIELDS = paa.Product.__slots__
+
+
+def product_record(product):
+    ''' a Product as a tuple of its fields, in FIELDS order '''
+    return tuple([getattr(product, field) for field in FIELDS])
+
+
+def record_product(record):
+    ''' the Product a product_record came from '''
+
+    product = paa.Product()
+    for (field, value) in zip(FIELDS, record):
+        setattr(product, field, value)
+    return product
+
+
+# each worker process's converter, made by _init_worker:
+_api = None
+
+def _init_worker(api_version):
+    global _api
+    _api = paa.ProductAdvertisingAPI(api_version=api_version)
+
+
+def _convert_batch(bodies):
+    ''' Runs in a worker.  Convert each ItemSearchResponse body, return a list of (True, compact response) or (False,
+        error message) in the same order.  A compact response is (request_id, is_valid, num_results, num_pages, records).
+    '''
+
+    converted = []
+    for body in bodies:
+        try:
+            response = _api.xml_string_to_item_search_response(body)
+            records = [product_record(p) for p in response.products]
+            converted.append((True, (response.request_id, response.is_valid, response.num_results, response.num_pages,
+                                     records)))
+        except Exception, e:
+            # exceptions don't always survive the trip back, send the message
+            converted.append((False, "%s: %s" % (e.__class__.__name__, e)))
+
+    return converted
+
+
+def _search_response(compact):
+    (request_id, is_valid, num_results, num_pages, records) = compact
+
+    response = paa.ItemSearchResponse()
+    response.request_id = request_id
+    response.is_valid = is_valid
+    response.num_results = num_results
+    response.num_pages = num_pages
+    response.products = [record_product(r) for r in records]
+    return response
+
+
+class ParsePool(object):
+    ''' Worker processes converting ItemSearchResponse bodies.
+
+        processes - number of worker processes, one per CPU if None.
+        batch_size - bodies sent to a worker at once.
+        api_version - the api version (and so xml namespace) of the responses.
+    '''
+
+    def __init__(self, processes=None, batch_size=4, api_version="2011-08-01"):
+        self.batch_size = batch_size
+        self.pool = multiprocessing.Pool(processes, _init_worker, (api_version,))
+
+    def convert(self, bodies):
+        ''' Convert ItemSearchResponse bodies in the worker processes.  Returns a list of workers.Result in the same order,
+            result.arg is the body's index and result.value the ItemSearchResponse, or result.error says why not.
+        '''
+
+        bodies = list(bodies)
+        batches = [bodies[i:i + self.batch_size] for i in xrange(0, len(bodies), self.batch_size)]
+
+        results = []
+        for converted in self.pool.imap(_convert_batch, batches):
+            for (ok, value) in converted:
+                result = workers.Result(len(results))
+                if ok:
+                    result.value = _search_response(value)
+                else:
+                    result.error = Exception(value)
+                results.append(result)
+
+        return results
+
+    def item_search_pages(self, api, keywords=None, pages=range(1, 6), max_workers=4, **search_params):
+        ''' Like api.item_search_pages, but only the fetching is done in this process.
+
+            Pages are fetched with at most max_workers requests in flight, then converted in the worker processes.
+            Returns a list of workers.Result in the same order as pages.
+        '''
+
+        def fetch(page):
+            f = api.fetch("ItemSearch", api.item_search_params(keywords, page=page, **search_params))
+            try:
+                return f.read()
+            finally:
+                f.close()
+
+        fetched = workers.pmap(fetch, pages, max_workers=max_workers)
+        converted = iter(self.convert([r.value for r in fetched if r.ok()]))
+
+        results = []
+        for fetch_result in fetched:
+            result = workers.Result(fetch_result.arg)
+            if fetch_result.ok():
+                c = converted.next()
+                (result.value, result.error) = (c.value, c.error)
+            else:
+                result.error = fetch_result.error
+            results.append(result)
+
+        return results
+
+    def close(self):
+        ''' let the workers finish and exit '''
+
+        self.pool.close()
+        self.pool.join()
@@ -0,0 +1,217 @@
+''' Local price and sales rank history for tracked ASINs, kept in SQLite.
+
+    Each lookup of an ASIN is recorded, but a row only goes into its history when its lowest new price or sales rank
+    differs from the last one recorded.  How often an ASIN is polled adapts to how often it changes: its interval is
+    cut on a change and stretched when nothing changed, between min_interval and max_interval.
+
+        history = PriceHistory("prices.db")
+        history.track(["B002HJJ2VA", "0307295676"])
+        while True:
+            for change in history.poll(api):
+                print change
+            time.sleep(60)
+
+    Readers use latest() and history() instead of asking amazon.
+'''
+
+import logging
+logger = logging.getLogger("amazon")
+import sqlite3
+import time
+
+SCHEMA = """
+create table if not exists items (
+    asin text primary key,
+    price real,             -- last lowest new price recorded, null if it had none
+    rank integer,           -- last sales rank recorded, null if it had none
+    last_checked real,      -- time of the last lookup
+    last_changed real,      -- time price or rank last changed
+    changes integer not null default 0,
+    interval real not null, -- seconds between polls
+    next_poll real not null
+);
+create index if not exists items_next_poll on items (next_poll);
+
+create table if not exists history (
+    asin text not null,
+    time real not null,
+    price real,
+    rank integer
+);
+create index if not exists history_asin_time on history (asin, time);
+"""
+
+
+class PriceChange(object):
+    ''' a tracked ASIN's price or rank moved '''
+
+    __slots__ = ("asin", "time", "old_price", "new_price", "old_rank", "new_rank")
+
+    def __init__(self, asin, time, old_price, new_price, old_rank, new_rank):
+        self.asin = asin
+        self.time = time
+        self.old_price = old_price
+        self.new_price = new_price
+        self.old_rank = old_rank
+        self.new_rank = new_rank
+
+    def price_delta(self):
+        ''' new price - old price, None if either is missing '''
+
+        if self.old_price is None or self.new_price is None:
+            return None
+        return self.new_price - self.old_price
+
+    def __str__(self):
+        return "ASIN %s price %s -> %s, rank %s -> %s" % (self.asin, self.old_price, self.new_price, self.old_rank,
+                                                          self.new_rank)
+
+
+class PriceHistory(object):
+    ''' Price and rank history, and a poll schedule, for tracked ASINs.
+
+        path - SQLite database file, ":memory:" for a throwaway one.
+        min_interval, max_interval - bounds on the seconds between polls of an ASIN.
+        speedup - an ASIN's interval is divided by this when its price or rank changes...
+        slowdown - ...and multiplied by this when it doesn't.
+
+        Use from one thread.  (poll does its lookups in parallel but records them itself)
+    '''
+
+    def __init__(self, path=":memory:", min_interval=15 * 60, max_interval=24 * 3600, speedup=2.0, slowdown=1.5):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.speedup = speedup
+        self.slowdown = slowdown
+
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def track(self, asins, now=None):
+        ''' start polling asins, due right away.  already tracked ones are left as they are. '''
+
+        if now is None:
+            now = time.time()
+
+        self.db.executemany("insert or ignore into items (asin, interval, next_poll) values (?, ?, ?)",
+                            [(asin, self.min_interval, now) for asin in asins])
+        self.db.commit()
+
+    def untrack(self, asin):
+        ''' stop polling asin.  its history is kept. '''
+
+        self.db.execute("delete from items where asin = ?", (asin,))
+        self.db.commit()
+
+    def record(self, product, now=None, commit=True):
+        ''' Record a looked up Product, reschedule its next poll and return a PriceChange if its price or rank moved (or
+            this is the first time it's been recorded), None otherwise.  An untracked ASIN starts being tracked.
+        '''
+
+        if now is None:
+            now = time.time()
+
+        asin = product.asin
+        price = product.lowest_new_price
+        rank = product.sales_rank
+        if rank is not None:
+            rank = int(rank)
+
+        row = self.db.execute("select price, rank, last_checked, interval from items where asin = ?", (asin,)).fetchone()
+        if row is None:
+            (old_price, old_rank, last_checked, interval) = (None, None, None, self.min_interval)
+        else:
+            (old_price, old_rank, last_checked, interval) = row
+
+        # first lookup, or a move:
+        changed = last_checked is None or price != old_price or rank != old_rank
+
+        if changed:
+            interval = max(self.min_interval, interval / self.speedup)
+            self.db.execute("insert into history (asin, time, price, rank) values (?, ?, ?, ?)", (asin, now, price, rank))
+        else:
+            interval = min(self.max_interval, interval * self.slowdown)
+
+        if row is None:
+            self.db.execute("insert into items (asin, price, rank, last_checked, last_changed, changes, interval, next_poll) "
+                            "values (?, ?, ?, ?, ?, 1, ?, ?)", (asin, price, rank, now, now, interval, now + interval))
+        elif changed:
+            self.db.execute("update items set price = ?, rank = ?, last_checked = ?, last_changed = ?, changes = changes + 1, "
+                            "interval = ?, next_poll = ? where asin = ?", (price, rank, now, now, interval, now + interval, asin))
+        else:
+            self.db.execute("update items set last_checked = ?, interval = ?, next_poll = ? where asin = ?",
+                            (now, interval, now + interval, asin))
+
+        if commit:
+            self.db.commit()
+
+        if changed:
+            return PriceChange(asin, now, old_price, price, old_rank, rank)
+        return None
+
+    def due(self, now=None, limit=None):
+        ''' tracked ASINs whose next poll is due, most overdue first '''
+
+        if now is None:
+            now = time.time()
+
+        sql = "select asin from items where next_poll <= ? order by next_poll"
+        params = (now,)
+        if limit is not None:
+            sql += " limit ?"
+            params = (now, limit)
+
+        return [asin for (asin,) in self.db.execute(sql, params)]
+
+    def poll(self, api, now=None, limit=None, max_workers=1, response_group="Medium"):
+        ''' Look up the ASINs that are due (see item_lookup_batch) and record them.  Returns the list of PriceChanges.
+
+            A failed lookup is retried at the ASIN's next interval, as if nothing had changed.
+        '''
+
+        if now is None:
+            now = time.time()
+
+        asins = self.due(now, limit)
+        if not asins:
+            return []
+
+        changes = []
+        errors = 0
+        for result in api.item_lookup_batch(asins, response_group, max_workers=max_workers):
+            if result.ok():
+                change = self.record(result.value.product, now, commit=False)
+                if change is not None:
+                    changes.append(change)
+            else:
+                errors += 1
+                self.db.execute("update items set next_poll = ? + interval where asin = ?", (now, result.arg))
+
+        self.db.commit()
+
+        logger.info("Polled %d ASINs: %d changed, %d failed" % (len(asins), len(changes), errors))
+        return changes
+
+    def latest(self, asin):
+        ''' (time, price, rank) last recorded for asin, None if it's never been looked up '''
+
+        return self.db.execute("select time, price, rank from history where asin = ? order by time desc limit 1",
+                               (asin,)).fetchone()
+
+    def history(self, asin, since=None):
+        ''' [(time, price, rank)] for every change to asin, oldest first, optionally only since a time '''
+
+        if since is None:
+            since = 0
+
+        return self.db.execute("select time, price, rank from history where asin = ? and time >= ? order by time",
+                               (asin, since)).fetchall()
+
+    def schedule(self, asin):
+        ''' (interval, next_poll, changes) for a tracked asin, None if it isn't tracked '''
+
+        return self.db.execute("select interval, next_poll, changes from items where asin = ?", (asin,)).fetchone()
@@ -7,14 +7,35 @@
 #
 
 from getch import getch
+import cache
 import paa
 import sys
+import typeahead
 
 CHAR_MIN = 3
+DEBOUNCE = 0.15     # seconds typing has to pause before we search
+
+# retyping (or backing up over) a search shouldn't search again:
+search_cache = cache.MemoryCache(ttls={"ItemSearch": 600})
+
+def show_results(query, products, final):
+    ''' print the top few results for the current query '''
+    
+    if final:
+        label = "results"
+    else:
+        label = "cached"
+        
+    sys.stdout.write("\r\n  [%s %s] %d products\r\n" % (label, query, len(products)))
+    for product in products[:5]:
+        sys.stdout.write("    %s\r\n" % product)
+    sys.stdout.write(">%s" % query)
+    sys.stdout.flush()
 
 def read_cmd():
 
-    api = paa.ProductAdvertisingAPI()
+    api = paa.ProductAdvertisingAPI(cache=search_cache)
+    search = typeahead.Typeahead(api, show_results, delay=DEBOUNCE, min_chars=CHAR_MIN)
 
     # do char by character searching 
     
@@ -23,12 +44,21 @@ def read_cmd():
         c = getch()
         if c == "\r" or c == "\n":
             break
-        sys.stdout.write(c)
-        cmd += c
+            
+        if c in ("\x7f", "\x08"):
+            # backspace
+            cmd = cmd[:-1]
+            sys.stdout.write("\b \b")
+        else:
+            sys.stdout.write(c)
+            cmd += c
         
-        if len(cmd) >= CHAR_MIN:
-            api.item_search(cmd)
-            sys.stdout.write("\n")
+        search.keystroke(cmd)
+            
+    search.wait()
+    sys.stdout.write("\r\n")
+    for line in search.report():
+        sys.stdout.write("  %s\r\n" % line)
             
 
 def cmdloop():
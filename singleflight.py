@@ -0,0 +1,135 @@
+''' Single-flight request coalescing.
+
+    When several callers ask for the same thing at once only the first one's call is made, the rest wait for it and
+    get the same result (or exception).  Nothing is kept once the call finishes, a later identical call is made again,
+    so this saves quota on hot ASINs and keywords without serving stale data.  (see cache.py for that)
+
+        flight = SingleFlight()
+        api = paa.ProductAdvertisingAPI(singleflight=flight)
+        ...
+        print flight.stats()
+
+    do() is for threads, do_async() for the AsyncResults of asyncpaa.  Callers share the response object, so don't
+    modify it.
+'''
+
+import sys
+import threading
+
+
+class _Call(object):
+    ''' one call in flight and everyone waiting on it '''
+
+    __slots__ = ("event", "value", "exc_info")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.exc_info = None
+
+
+class SingleFlight(object):
+    ''' Coalesces identical concurrent calls, identified by a hashable key. '''
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.calls = {}         # key -> _Call in flight, for do()
+        self.async_calls = {}   # key -> AsyncResult in flight, for do_async()
+
+        self.requests = 0       # calls asked for
+        self.executions = 0     # calls actually made
+
+    def do(self, key, func):
+        ''' return func(), unless a call with key is already in flight in another thread: then wait for it and return
+            (or raise) what it does.
+        '''
+
+        self.lock.acquire()
+        try:
+            self.requests += 1
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self.calls[key] = call
+                self.executions += 1
+        finally:
+            self.lock.release()
+
+        if not leader:
+            call.event.wait()
+            if call.exc_info is not None:
+                raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+            return call.value
+
+        try:
+            try:
+                call.value = func()
+            except:
+                call.exc_info = sys.exc_info()
+                raise
+        finally:
+            self.lock.acquire()
+            try:
+                del self.calls[key]
+            finally:
+                self.lock.release()
+            call.event.set()
+
+        return call.value
+
+    def do_async(self, key, start):
+        ''' start() returns an AsyncResult.  return it, unless a call with key is already in flight: then return that
+            call's AsyncResult instead.
+        '''
+
+        # start() is made holding the lock, so a second caller can't start the same call before this one's result is
+        # stored.  (it only sends the request.  a reentrant lock, in case it calls back into here)
+        self.lock.acquire()
+        try:
+            self.requests += 1
+            result = self.async_calls.get(key)
+            if result is not None:
+                return result
+            self.executions += 1
+
+            result = start()
+            pending = not result.done()
+            if pending:
+                self.async_calls[key] = result
+        finally:
+            self.lock.release()
+
+        if pending:
+            def forget(result):
+                self.lock.acquire()
+                try:
+                    if self.async_calls.get(key) is result:
+                        del self.async_calls[key]
+                finally:
+                    self.lock.release()
+
+            result.add_callback(forget)
+
+        return result
+
+    def stats(self):
+        ''' requests, executions, coalesced (requests that shared another's call) and ratio (coalesced / requests) '''
+
+        self.lock.acquire()
+        try:
+            coalesced = self.requests - self.executions
+            if self.requests:
+                ratio = float(coalesced) / self.requests
+            else:
+                ratio = 0.0
+
+            return {
+                "requests": self.requests,
+                "executions": self.executions,
+                "coalesced": coalesced,
+                "ratio": ratio,
+                "in_flight": len(self.calls) + len(self.async_calls),
+            }
+        finally:
+            self.lock.release()
@@ -0,0 +1,367 @@
+''' Tests for net's connection pool and resilience policy, against a MockServer.  run with: python -m unittest discover -p "test_*.py" '''
+
+import logging
+import socket
+import threading
+import time
+import unittest
+import urllib
+import urllib2
+
+import mockserver
+import net
+
+# failures are expected here, don't warn that there's nowhere to log them
+logging.getLogger("amazon").addHandler(logging.NullHandler())
+
+
+def lookup_url(server, asin="M000000001"):
+    return "http://%s/onca/xml?%s" % (server.host, urllib.urlencode({"Operation": "ItemLookup", "ItemId": asin}))
+
+
+class MockServerTestCase(unittest.TestCase):
+    ''' a MockServer per test, made with server_options '''
+
+    server_options = {}
+
+    def setUp(self):
+        self.server = mockserver.MockServer(**self.server_options)
+        self.server.start()
+        self.pools = []
+
+    def tearDown(self):
+        # (the server first: it waits for requests still being answered, e.x. a hedged request that lost)
+        self.server.stop()
+        for pool in self.pools:
+            pool.close()
+
+    def pool(self, **kwargs):
+        pool = net.ConnectionPool(**kwargs)
+        self.pools.append(pool)
+        return pool
+
+
+class ConnectionPoolTest(MockServerTestCase):
+
+    def idle(self, pool):
+        return sum([len(conns) for conns in pool.idle.values()])
+
+    def test_reuses_connection(self):
+        pool = self.pool()
+        for asin in ("M1", "M2", "M3"):
+            self.assertTrue("<ASIN>%s</ASIN>" % asin in pool.get(lookup_url(self.server, asin)))
+
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(self.idle(pool), 1)
+
+    def test_evicts_idle_connections(self):
+        pool = self.pool(idle_timeout=0.05)
+        pool.get(lookup_url(self.server))
+        self.assertEqual(self.idle(pool), 1)
+
+        time.sleep(0.1)
+        pool.evict_idle()
+        self.assertEqual(self.idle(pool), 0)
+
+        pool.get(lookup_url(self.server))
+        self.assertEqual(self.server.connections, 2)
+
+    def test_stale_connection_not_reused(self):
+        pool = self.pool(idle_timeout=0.05)
+        pool.get(lookup_url(self.server))
+        time.sleep(0.1)
+        pool.get(lookup_url(self.server))
+
+        self.assertEqual(self.server.connections, 2)
+        self.assertEqual(self.idle(pool), 1)
+
+    def test_max_idle_per_host(self):
+        pool = self.pool(max_idle_per_host=1)
+        streams = [pool.open(lookup_url(self.server, "M%d" % i)) for i in xrange(3)]
+        for f in streams:
+            f.read()
+
+        self.assertEqual(self.server.connections, 3)
+        self.assertEqual(self.idle(pool), 1)
+        self.assertEqual(pool.busy, {})
+
+    def test_max_connections_per_host(self):
+        pool = self.pool(max_connections_per_host=2, connect_timeout=0.1)
+        streams = [pool.open(lookup_url(self.server, "M%d" % i)) for i in xrange(2)]
+
+        start = time.time()
+        self.assertRaises(net.PoolTimeout, pool.open, lookup_url(self.server))
+        self.assertTrue(time.time() - start >= 0.1)
+        self.assertEqual(self.server.connections, 2)
+
+        # a stream given up on frees its connection too
+        streams[0].close()
+        streams.append(pool.open(lookup_url(self.server)))
+
+        # a request waits for a connection to be returned
+        waiting = threading.Thread(target=lambda: streams.append(pool.open(lookup_url(self.server))))
+        waiting.start()
+        time.sleep(0.05)
+        self.assertEqual(len(streams), 3)
+        streams[1].read()
+        waiting.join()
+
+        for f in streams[2:]:
+            f.read()
+        self.assertEqual(pool.busy, {})
+        self.assertEqual(self.server.connections, 3)
+
+    def test_gzip(self):
+        for gzip in (True, False):
+            body = self.pool(gzip=gzip).get(lookup_url(self.server, "M7"))
+            self.assertTrue(body.startswith("<?xml"))
+            self.assertTrue("<ASIN>M7</ASIN>" in body)
+
+    def test_http_error(self):
+        self.server.inject(500)
+        pool = self.pool()
+        try:
+            pool.get(lookup_url(self.server))
+            self.fail("no HTTPError")
+        except urllib2.HTTPError, e:
+            self.assertEqual(e.code, 500)
+
+        # the error body was read, so the connection is still good
+        pool.get(lookup_url(self.server))
+        self.assertEqual(self.server.connections, 1)
+
+    def test_max_body_size(self):
+        pool = self.pool()
+        self.assertRaises(net.ResponseTooLarge, pool.get, lookup_url(self.server), max_body_size=100)
+
+    def test_stream_closed_early(self):
+        pool = self.pool(gzip=False)
+        self.server.total_results = self.server.items_per_page = 200
+        f = pool.open("http://%s/onca/xml?Operation=ItemSearch&Keywords=x" % self.server.host)
+        self.assertTrue(f.read(100))
+        f.close()
+
+        # the rest of the body was never read, so the connection can't go back in the pool
+        self.assertEqual(self.idle(pool), 0)
+        self.assertTrue(f.conn is None)
+
+
+class ChunkedConnectionPoolTest(ConnectionPoolTest):
+    server_options = {"framing": "chunked"}
+
+
+class CloseDelimitedConnectionPoolTest(MockServerTestCase):
+    server_options = {"framing": "close"}
+
+    def test_not_reused(self):
+        pool = self.pool()
+        for gzip in (True, False):
+            pool.gzip = gzip
+            for asin in ("M1", "M2"):
+                self.assertTrue("<ASIN>%s</ASIN>" % asin in pool.get(lookup_url(self.server, asin)))
+
+        self.assertEqual(self.server.connections, 4)
+        self.assertEqual(sum([len(conns) for conns in pool.idle.values()]), 0)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def test_open_half_open_closed(self):
+        breaker = net.CircuitBreaker(failure_threshold=2, reset_timeout=10.0)
+        self.assertTrue(breaker.allow(0.0))
+        self.assertFalse(breaker.failure(0.0))
+        self.assertTrue(breaker.failure(1.0))
+        self.assertEqual(breaker.state, net.CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow(5.0))
+
+        # one trial once reset_timeout is up, no one else until it's done
+        self.assertTrue(breaker.allow(11.0))
+        self.assertEqual(breaker.state, net.CircuitBreaker.HALF_OPEN)
+        self.assertFalse(breaker.allow(11.0))
+
+        breaker.success()
+        self.assertEqual(breaker.state, net.CircuitBreaker.CLOSED)
+        self.assertTrue(breaker.allow(12.0))
+
+    def test_failed_trial_reopens(self):
+        breaker = net.CircuitBreaker(failure_threshold=1, reset_timeout=10.0)
+        breaker.failure(0.0)
+        self.assertTrue(breaker.allow(10.0))
+        self.assertTrue(breaker.failure(10.0))
+        self.assertEqual(breaker.state, net.CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow(15.0))
+        self.assertTrue(breaker.allow(20.0))
+
+    def test_success_resets_failures(self):
+        breaker = net.CircuitBreaker(failure_threshold=2)
+        breaker.failure(0.0)
+        breaker.success()
+        self.assertFalse(breaker.failure(0.0))
+        self.assertEqual(breaker.state, net.CircuitBreaker.CLOSED)
+
+
+class RetryBudgetTest(unittest.TestCase):
+
+    def test_budget(self):
+        budget = net.RetryBudget(ratio=0.5, min_retries=1, window=10.0)
+        self.assertTrue(budget.retry(0.0))
+        self.assertFalse(budget.retry(0.0))
+
+        for i in xrange(4):
+            budget.request(1.0)
+        self.assertTrue(budget.retry(1.0))
+        self.assertTrue(budget.retry(1.0))
+        self.assertFalse(budget.retry(1.0))
+
+        # everything has left the window
+        self.assertTrue(budget.retry(20.0))
+
+
+class ResiliencePolicyTest(MockServerTestCase):
+
+    def get(self, policy, pool=None, url=None):
+        if pool is None:
+            pool = self.pool()
+        return net.get(url or lookup_url(self.server), pool=pool, policy=policy).read()
+
+    def test_retries_500(self):
+        self.server.inject(500, count=2)
+        policy = net.ResiliencePolicy(max_retries=3, backoff=0.001)
+
+        self.assertTrue("<ASIN>" in self.get(policy))
+        self.assertEqual(self.server.statuses, {500: 2, 200: 1})
+        self.assertEqual(policy.stats()["retries"], 2)
+
+    def test_gives_up_after_max_retries(self):
+        self.server.inject(502, count=3)
+        policy = net.ResiliencePolicy(max_retries=2, backoff=0.001)
+
+        try:
+            self.get(policy)
+            self.fail("no HTTPError")
+        except urllib2.HTTPError, e:
+            self.assertEqual(e.code, 502)
+        self.assertEqual(self.server.statuses, {502: 3})
+
+    def test_retry_budget(self):
+        self.server.error_rate = 1.0
+        policy = net.ResiliencePolicy(max_retries=5, backoff=0.001, retry_budget=net.RetryBudget(ratio=0.0, min_retries=1))
+
+        self.assertRaises(urllib2.HTTPError, self.get, policy)
+        self.assertEqual(self.server.statuses, {500: 2})
+        self.assertEqual(policy.stats()["retries_denied"], 1)
+
+    def test_no_retry_on_throttle_or_client_error(self):
+        policy = net.ResiliencePolicy(max_retries=3, backoff=0.001)
+        for status in (503, 400):
+            self.server.inject(status)
+            self.assertRaises(urllib2.HTTPError, self.get, policy)
+        self.assertEqual(self.server.statuses, {503: 1, 400: 1})
+        self.assertEqual(policy.stats()["retries"], 0)
+
+    def test_circuit_breaker(self):
+        policy = net.ResiliencePolicy(max_retries=0, failure_threshold=2, reset_timeout=0.2)
+        pool = self.pool()
+
+        self.server.inject(500, count=2)
+        self.assertRaises(urllib2.HTTPError, self.get, policy, pool)
+        self.assertRaises(urllib2.HTTPError, self.get, policy, pool)
+
+        # open: refused without a request
+        self.assertRaises(net.CircuitOpen, self.get, policy, pool)
+        self.assertEqual(self.server.statuses, {500: 2})
+        self.assertEqual(policy.stats()["open_circuits"], 1)
+
+        # half open after reset_timeout: a failed trial opens it again...
+        time.sleep(0.25)
+        self.server.inject(500)
+        self.assertRaises(urllib2.HTTPError, self.get, policy, pool)
+        self.assertRaises(net.CircuitOpen, self.get, policy, pool)
+
+        # ...a good one closes it
+        time.sleep(0.25)
+        self.assertTrue("<ASIN>" in self.get(policy, pool))
+        self.assertTrue("<ASIN>" in self.get(policy, pool))
+        self.assertEqual(policy.stats()["open_circuits"], 0)
+        self.assertEqual(policy.stats()["rejected"], 2)
+
+    def test_circuit_opened_by_retries(self):
+        policy = net.ResiliencePolicy(max_retries=3, backoff=0.001, failure_threshold=2, reset_timeout=60.0)
+        pool = self.pool()
+        self.server.inject(500, count=3)
+
+        # the failure that opened the circuit is raised, not a retry's CircuitOpen
+        try:
+            self.get(policy, pool)
+            self.fail("no HTTPError")
+        except urllib2.HTTPError, e:
+            self.assertEqual(e.code, 500)
+        self.assertEqual(self.server.statuses, {500: 2})
+        self.assertEqual((policy.stats()["retries"], policy.stats()["rejected"]), (1, 0))
+
+        self.assertRaises(net.CircuitOpen, self.get, policy, pool)
+
+    def test_unreachable_endpoint_opens_circuit(self):
+        self.server.stop()
+        policy = net.ResiliencePolicy(max_retries=0, failure_threshold=1, reset_timeout=60.0)
+
+        self.assertRaises(urllib2.URLError, self.get, policy)
+        self.assertRaises(net.CircuitOpen, self.get, policy)
+        self.server.start()
+
+    def test_read_timeout(self):
+        self.server.inject(200, delay=0.3)
+        pool = self.pool(read_timeout=0.05)
+
+        start = time.time()
+        self.assertRaises(urllib2.URLError, self.get, None, pool)
+        self.assertTrue(time.time() - start < 0.25)
+
+        # a timeout is retried like any other failure
+        self.server.inject(200, delay=0.3)
+        policy = net.ResiliencePolicy(max_retries=1, backoff=0.001)
+        start = time.time()
+        self.assertTrue("<ASIN>" in self.get(policy, pool))
+        self.assertTrue(time.time() - start < 0.25)
+        self.assertEqual(policy.stats()["retries"], 1)
+
+    def test_default_read_timeout(self):
+        default = socket.getdefaulttimeout()
+        socket.setdefaulttimeout(0.05)
+        try:
+            pool = self.pool(read_timeout=None)
+            self.server.inject(200, delay=0.3)
+            start = time.time()
+            self.assertRaises(urllib2.URLError, self.get, None, pool)
+            self.assertTrue(time.time() - start < 0.25)
+        finally:
+            socket.setdefaulttimeout(default)
+
+    def test_hedging(self):
+        policy = net.ResiliencePolicy(hedge_percentile=50, hedge_min_samples=5, min_hedge_delay=0.01)
+        pool = self.pool()
+        for i in xrange(5):
+            self.get(policy, pool)
+        self.assertEqual(policy.stats()["hedges"], 0)
+
+        # the first attempt stalls, the hedge sent after the median latency answers
+        self.server.inject(200, delay=0.3)
+        start = time.time()
+        self.assertTrue("<ASIN>" in self.get(policy, pool))
+        self.assertTrue(time.time() - start < 0.25)
+
+        stats = policy.stats()
+        self.assertEqual((stats["hedges"], stats["hedge_wins"]), (1, 1))
+
+    def test_no_hedging_by_default(self):
+        policy = net.ResiliencePolicy()
+        pool = self.pool()
+        for i in xrange(30):
+            self.get(policy, pool)
+        self.server.inject(200, delay=0.2)
+        self.get(policy, pool)
+        self.assertEqual(policy.stats()["hedges"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
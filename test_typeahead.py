@@ -0,0 +1,186 @@
+''' Tests for typeahead, with a fake api.  run with: python -m unittest discover -p "test_*.py" '''
+
+import threading
+import time
+import unittest
+
+import paa
+import typeahead
+
+
+class FakeResponse(object):
+
+    def __init__(self, products):
+        self.products = products
+        self.num_results = len(products)
+
+
+class FakeAPI(object):
+    ''' matches whole words of titles, like amazon's keyword search does.  delays - keywords -> seconds to take '''
+
+    titles = (u"Stumbling on Happiness", u"Stumble Upon", u"Stuart Little", u"Zombie Survival Guide")
+
+    def __init__(self, delays=None):
+        self.delays = delays or {}
+        self.lock = threading.Lock()
+        self.calls = []
+
+    def item_search(self, keywords=None, **search_params):
+        self.lock.acquire()
+        try:
+            self.calls.append(keywords)
+        finally:
+            self.lock.release()
+
+        time.sleep(self.delays.get(keywords, 0.0))
+
+        words = keywords.lower().split()
+        products = []
+        for title in self.titles:
+            if all([word in title.lower().split() for word in words]):
+                product = paa.Product()
+                product.title = title
+                products.append(product)
+        return FakeResponse(products)
+
+
+class TypeaheadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.results = []
+
+    def on_results(self, query, products, final):
+        self.results.append((query, [p.title for p in products], final))
+
+    def typeahead(self, api, delay=0.0):
+        return typeahead.Typeahead(api, self.on_results, delay=delay, min_chars=3)
+
+    def test_prefix_results_are_a_preview(self):
+        api = FakeAPI()
+        t = self.typeahead(api)
+        for query in ("stu", "stum", "stumbling"):
+            t.keystroke(query)
+            t.wait()
+
+        # "stu" matches no whole word, but that says nothing about longer queries
+        self.assertEqual(api.calls, ["stu", "stum", "stumbling"])
+        self.assertEqual(self.results[-2:], [("stumbling", [], False), ("stumbling", [u"Stumbling on Happiness"], True)])
+
+    def test_prefix_preview_filters_by_title(self):
+        api = FakeAPI()
+        t = self.typeahead(api)
+        t.keystroke("stumbling")
+        t.wait()
+        t.keystroke("stumbling on")
+        t.wait()
+
+        self.assertEqual(self.results[1], ("stumbling on", [u"Stumbling on Happiness"], False))
+        self.assertEqual(api.calls, ["stumbling", "stumbling on"])
+
+    def test_searched_query_answered_from_cache(self):
+        api = FakeAPI()
+        t = self.typeahead(api)
+        t.keystroke("zombie")
+        t.wait()
+        t.keystroke("Zombie ")
+        t.wait()
+
+        self.assertEqual(api.calls, ["zombie"])
+        self.assertEqual(self.results[-1], ("Zombie ", [u"Zombie Survival Guide"], True))
+
+    def test_too_short(self):
+        api = FakeAPI()
+        t = self.typeahead(api)
+        t.keystroke("st")
+        t.wait()
+
+        self.assertEqual(api.calls, [])
+        self.assertEqual(self.results, [])
+
+    def test_debounce(self):
+        api = FakeAPI()
+        t = self.typeahead(api, delay=0.1)
+        for query in ("stu", "stum", "stumb", "stumble"):
+            t.keystroke(query)
+        t.wait()
+
+        self.assertEqual(api.calls, ["stumble"])
+        self.assertEqual(self.results, [("stumble", [u"Stumble Upon"], True)])
+        self.assertEqual([ks.cancelled for ks in t.keystrokes], [True, True, True, False])
+
+    def test_coalesces_query_in_flight(self):
+        api = FakeAPI({"zombie": 0.2})
+        t = self.typeahead(api)
+        t.keystroke("zombie")
+        t.keystroke("zombie ")
+        t.wait()
+
+        self.assertEqual(api.calls, ["zombie"])
+        self.assertEqual(t.searches, 1)
+        self.assertTrue(t.keystrokes[1].coalesced)
+        self.assertEqual(self.results, [("zombie ", [u"Zombie Survival Guide"], True)])
+
+    def test_drops_superseded_results(self):
+        api = FakeAPI({"stuart": 0.2})
+        t = self.typeahead(api)
+        t.keystroke("stuart")
+        t.keystroke("zombie")
+        t.wait()
+
+        self.assertEqual(sorted(api.calls), ["stuart", "zombie"])
+        self.assertEqual(self.results, [("zombie", [u"Zombie Survival Guide"], True)])
+        self.assertTrue(t.keystrokes[0].cancelled)
+
+
+class PrefixCacheTest(unittest.TestCase):
+
+    def product(self, title):
+        product = paa.Product()
+        product.title = title
+        return product
+
+    def test_lookup(self):
+        cache = typeahead.PrefixCache()
+        self.assertEqual(cache.lookup("stumbling"), (None, False))
+
+        cache.insert("Stumb", [self.product(u"Stumbling on Happiness"), self.product(u"Stumble Upon")])
+        (products, exact) = cache.lookup("stumb")
+        self.assertEqual((len(products), exact), (2, True))
+
+        (products, exact) = cache.lookup("stumbl  upon")
+        self.assertEqual(([p.title for p in products], exact), ([u"Stumble Upon"], False))
+
+        self.assertEqual(cache.lookup("stu"), (None, False))
+
+    def test_evicts_least_recently_used(self):
+        cache = typeahead.PrefixCache(max_entries=2)
+        cache.insert("stumb", [self.product(u"Stumble Upon")])
+        cache.insert("zombie", [self.product(u"Zombie Survival Guide")])
+
+        # a prefix answer counts as a use
+        self.assertEqual(cache.lookup("stumble")[1], False)
+        cache.insert("stuart", [self.product(u"Stuart Little")])
+
+        self.assertEqual(cache.lookup("zombie"), (None, False))
+        self.assertEqual(cache.lookup("stumb")[1], True)
+        self.assertEqual(cache.lookup("stuart")[1], True)
+        self.assertEqual((cache.size, cache.evictions), (2, 1))
+
+        # the evicted query's trie nodes go with it, shared ones stay
+        self.assertFalse("z" in cache.root.children)
+        cache.insert("stumbling", [])
+        self.assertEqual(cache.lookup("stumb"), (None, False))
+        self.assertEqual(sorted(cache.root.children["s"].children["t"].children["u"].children.keys()), ["a", "m"])
+
+    def test_typeahead_max_cached(self):
+        t = typeahead.Typeahead(FakeAPI(), lambda query, products, final: None, delay=0.0, max_cached=2)
+        for query in ("stuart", "zombie", "stumble"):
+            t.keystroke(query)
+            t.wait()
+
+        self.assertEqual(t.cache.size, 2)
+        self.assertEqual(t.cache.lookup("stuart"), (None, False))
+
+
+if __name__ == '__main__':
+    unittest.main()
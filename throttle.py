@@ -0,0 +1,185 @@
+''' Client side rate limiting for PA-API requests.
+
+    Amazon allows about 1 request per second per access key and answers 503 past that.  A RequestScheduler shared by
+    everything using the same keys makes callers take turns: each key gets a token bucket, waiting callers go in
+    priority order (INTERACTIVE before BATCH), and throttled requests are retried with exponential backoff and jitter.
+
+        scheduler = throttle.RequestScheduler(rate=1.0)
+        web_api = paa.ProductAdvertisingAPI(key, secret, tag, scheduler=scheduler)
+        job_api = paa.ProductAdvertisingAPI(key, secret, tag, scheduler=scheduler, priority=throttle.BATCH)
+'''
+
+import heapq
+import itertools
+import logging
+logger = logging.getLogger("amazon")
+import random
+import threading
+import time
+
+INTERACTIVE = 0
+BATCH = 10
+
+
+def is_throttled(error):
+    ''' True if error is amazon telling us to slow down '''
+    return getattr(error, "code", None) == 503
+
+
+class TokenBucket(object):
+    ''' rate tokens per second, holding at most burst of them.  not thread safe, RequestScheduler locks around it. '''
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.paused_until = 0.0
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        ''' seconds until a token is available '''
+
+        self.refill(now)
+        wait = max(0.0, self.paused_until - now)
+        if self.tokens < 1.0:
+            wait = max(wait, (1.0 - self.tokens) / self.rate)
+        return wait
+
+    def take(self, now):
+        self.refill(now)
+        self.tokens -= 1.0
+
+    def pause(self, now, seconds):
+        ''' hand out nothing for the next few seconds (we're being throttled) '''
+        self.paused_until = max(self.paused_until, now + seconds)
+        self.tokens = min(self.tokens, 0.0)
+
+
+class RequestScheduler(object):
+    ''' Hands out request slots per key, in priority order, no faster than each key's token bucket allows.
+
+        rate - requests per second per key.
+        burst - requests a key can make back to back after being idle.
+        max_retries - times a throttled request is retried before its error is raised.
+        backoff - seconds to wait after the first throttle, doubled each retry up to max_backoff.  jittered.
+    '''
+
+    def __init__(self, rate=1.0, burst=1, max_retries=4, backoff=1.0, max_backoff=30.0):
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.lock = threading.Condition()
+        self.buckets = {}       # key -> TokenBucket
+        self.queues = {}        # key -> heap of (priority, sequence) tickets
+        self.sequence = itertools.count()
+
+        # metrics
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.requests = 0
+        self.throttled = 0
+        self.retries = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def run(self, key, func, priority=INTERACTIVE):
+        ''' call func() when key's turn comes up, retrying it if it is throttled.  returns what func returns. '''
+
+        attempt = 0
+        while True:
+            self.acquire(key, priority)
+            try:
+                return func()
+            except Exception, e:
+                if not is_throttled(e) or attempt >= self.max_retries:
+                    raise
+
+                delay = min(self.max_backoff, self.backoff * (2 ** attempt))
+                delay = random.uniform(delay / 2.0, delay)
+                logger.warning("Throttled, retrying in %.2f seconds" % delay)
+
+                self.lock.acquire()
+                try:
+                    self.throttled += 1
+                    self.retries += 1
+                    self.bucket(key).pause(time.time(), delay)
+                finally:
+                    self.lock.release()
+
+                attempt += 1
+
+    def bucket(self, key):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst)
+            self.buckets[key] = bucket
+        return bucket
+
+    def acquire(self, key, priority=INTERACTIVE):
+        ''' block until it's this caller's turn to make a request with key '''
+
+        started = time.time()
+        ticket = (priority, self.sequence.next())
+
+        self.lock.acquire()
+        try:
+            queue = self.queues.setdefault(key, [])
+            heapq.heappush(queue, ticket)
+            self.queue_depth += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+
+            # anyone already waiting needs to check whether they're still first in line:
+            self.lock.notify_all()
+
+            bucket = self.bucket(key)
+            while True:
+                if queue[0] == ticket:
+                    now = time.time()
+                    delay = bucket.delay(now)
+                    if delay <= 0:
+                        bucket.take(now)
+                        break
+                    self.lock.wait(delay)
+                else:
+                    self.lock.wait()
+
+            heapq.heappop(queue)
+            self.queue_depth -= 1
+
+            waited = time.time() - started
+            self.requests += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+
+            self.lock.notify_all()
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        ''' queue depth and wait time metrics as a dict '''
+
+        self.lock.acquire()
+        try:
+            if self.requests:
+                mean_wait = self.total_wait / self.requests
+            else:
+                mean_wait = 0.0
+
+            return {
+                "queue_depth": self.queue_depth,
+                "max_queue_depth": self.max_queue_depth,
+                "requests": self.requests,
+                "throttled": self.throttled,
+                "retries": self.retries,
+                "mean_wait": mean_wait,
+                "max_wait": self.max_wait,
+            }
+        finally:
+            self.lock.release()
@@ -0,0 +1,322 @@
+''' Search-as-you-type on top of item_search.
+
+    Typeahead takes the query after every keystroke and:
+
+    - answers right away from earlier results, if a shorter query's results are cached (typing "stumbl" after "stumb"
+      filters the "stumb" products locally).  that's only a preview: amazon matches whole words, so "stumb" results
+      aren't a superset of "stumbl" ones, and the search still goes out.
+    - debounces: the network search only goes out once typing pauses for delay seconds.  a newer keystroke cancels it.
+    - coalesces: a query already being searched for isn't searched for again, its caller waits for the same result.
+    - discards the results of superseded searches, so a slow search can't overwrite a newer one.  (a search already
+      sent isn't aborted, its results are only dropped when they come back)
+    - records per-keystroke latency: time to the local answer and time to the network answer.
+
+    The api only needs item_search(keywords) returning something with products, so a fake one will do.
+'''
+
+from collections import OrderedDict
+import logging
+logger = logging.getLogger("amazon")
+import threading
+import time
+
+
+def matches(product, words):
+    ''' True if every word of the query is in the product's title.  (the last word may be partly typed) '''
+
+    title = (product.title or u"").lower()
+    for word in words:
+        if word not in title:
+            return False
+    return True
+
+
+class _TrieNode(object):
+    __slots__ = ("children", "products")
+
+    def __init__(self):
+        self.children = {}
+        self.products = None    # results for the query ending here, if searched
+
+
+class PrefixCache(object):
+    ''' Search results in a trie keyed by query, so a query can be answered from its longest searched prefix.
+
+        max_entries - most queries' results kept.  the least recently used are evicted past that.
+    '''
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self.root = _TrieNode()
+        self.size = 0
+        self.evictions = 0
+
+        self.lock = threading.Lock()
+        self.recent = OrderedDict()     # normalized query -> None, least recently used first
+
+    def normalize(self, query):
+        return u" ".join(query.lower().split())
+
+    def insert(self, query, products):
+        query = self.normalize(query)
+
+        self.lock.acquire()
+        try:
+            node = self.root
+            for c in query:
+                child = node.children.get(c)
+                if child is None:
+                    child = _TrieNode()
+                    node.children[c] = child
+                node = child
+
+            if node.products is None:
+                self.size += 1
+            node.products = list(products)
+
+            self.recent.pop(query, None)
+            self.recent[query] = None
+            while self.size > self.max_entries:
+                (oldest, _) = self.recent.popitem(last=False)
+                self.remove(oldest)
+                self.evictions += 1
+        finally:
+            self.lock.release()
+
+    def remove(self, query):
+        ''' drop query's results, and the trie nodes only it was using.  (called holding the lock) '''
+
+        path = [self.root]
+        for c in query:
+            path.append(path[-1].children[c])
+
+        path[-1].products = None
+        self.size -= 1
+
+        for i in xrange(len(query), 0, -1):
+            node = path[i]
+            if node.products is not None or node.children:
+                break
+            del path[i - 1].children[query[i - 1]]
+
+    def lookup(self, query):
+        ''' Return (products, exact) for query, or (None, False) if nothing is cached for it or any prefix of it.
+
+            exact is True only if query itself was searched.  Otherwise products are a prefix's results filtered by
+            title, a preview: keyword search matches whole words, so the prefix's results can miss some of query's.
+        '''
+
+        query = self.normalize(query)
+
+        self.lock.acquire()
+        try:
+            node = self.root
+            best = None
+            depth = 0
+            for c in query:
+                node = node.children.get(c)
+                if node is None:
+                    break
+                depth += 1
+                if node.products is not None:
+                    best = (node, depth)
+
+            if best is None:
+                return (None, False)
+
+            (node, depth) = best
+            products = node.products
+
+            # move to the most recently used end
+            prefix = query[:depth]
+            del self.recent[prefix]
+            self.recent[prefix] = None
+        finally:
+            self.lock.release()
+
+        if depth == len(query):
+            return (products, True)
+
+        words = query.split()
+        products = [p for p in products if matches(p, words)]
+        return (products, False)
+
+
+class Keystroke(object):
+    ''' latency record for one keystroke '''
+
+    __slots__ = ("query", "typed", "local_latency", "network_latency", "coalesced", "cancelled")
+
+    def __init__(self, query, typed):
+        self.query = query
+        self.typed = typed              # time the keystroke came in
+        self.local_latency = None       # seconds to the answer from the cache, if there was one
+        self.network_latency = None     # seconds to the search result, if it was searched and not cancelled
+        self.coalesced = False          # True if it shared another keystroke's search
+        self.cancelled = False          # True if a newer keystroke superseded it.  (its debounce timer is cancelled,
+                                        # or if its search was already sent, the results are discarded)
+
+    def __str__(self):
+        def ms(latency):
+            if latency is None:
+                return "-"
+            return "%.1fms" % (latency * 1000)
+
+        return "%r local %s network %s%s%s" % (self.query, ms(self.local_latency), ms(self.network_latency),
+                                              self.coalesced and " (coalesced)" or "",
+                                              self.cancelled and " (superseded)" or "")
+
+
+class Typeahead(object):
+    ''' Debounced, coalesced, prefix-cached search as you type.
+
+        api - ProductAdvertisingAPI (or a stand-in with item_search(keywords))
+        on_results - called as on_results(query, products, final) with products for the current query.  final is
+                     False for a local answer from the cache, True for the search's answer.  called from a worker
+                     thread for search results.
+        delay - seconds typing has to pause for before searching.
+        min_chars - shortest query worth searching for.
+        max_cached - most queries' results kept for answering locally.
+    '''
+
+    def __init__(self, api, on_results, delay=0.15, min_chars=3, search_params=None, max_cached=1000):
+        self.api = api
+        self.on_results = on_results
+        self.delay = delay
+        self.min_chars = min_chars
+        self.search_params = search_params or {}
+
+        self.cache = PrefixCache(max_cached)
+
+        self.lock = threading.Lock()
+        self.current = None         # latest Keystroke
+        self.timer = None           # pending debounce timer
+        self.inflight = {}          # normalized query -> list of Keystrokes waiting on its search
+        self.threads = []
+        self.keystrokes = []
+
+        self.searches = 0
+
+    def keystroke(self, query):
+        ''' the query is now this '''
+
+        ks = Keystroke(query, time.time())
+
+        self.lock.acquire()
+        try:
+            if self.current is not None and self.current.network_latency is None:
+                self.current.cancelled = True
+            self.current = ks
+            self.keystrokes.append(ks)
+
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        finally:
+            self.lock.release()
+
+        if len(query.strip()) < self.min_chars:
+            return
+
+        (products, exact) = self.cache.lookup(query)
+        if products is not None:
+            ks.local_latency = time.time() - ks.typed
+            self.on_results(query, products, exact)
+            if exact:
+                # this exact query was already searched
+                ks.network_latency = ks.local_latency
+                return
+
+        if self.delay > 0:
+            timer = threading.Timer(self.delay, self.search, (ks,))
+            timer.daemon = True
+            self.lock.acquire()
+            try:
+                if self.current is ks:
+                    self.timer = timer
+                    timer.start()
+            finally:
+                self.lock.release()
+        else:
+            self.search(ks)
+
+    def search(self, ks):
+        ''' debounce timer fired: search for ks.query unless it's been superseded or is already being searched '''
+
+        key = self.cache.normalize(ks.query)
+
+        self.lock.acquire()
+        try:
+            if self.current is not ks:
+                return
+
+            waiting = self.inflight.get(key)
+            if waiting is not None:
+                ks.coalesced = True
+                waiting.append(ks)
+                return
+
+            self.inflight[key] = [ks]
+            self.searches += 1
+
+            t = threading.Thread(target=self.run_search, args=(key, ks.query))
+            t.daemon = True
+            self.threads.append(t)
+        finally:
+            self.lock.release()
+
+        t.start()
+
+    def run_search(self, key, query):
+        try:
+            response = self.api.item_search(keywords=query, **self.search_params)
+            products = list(response.products)
+            self.cache.insert(query, products)
+        except Exception, e:
+            logger.error("Typeahead search for %r failed: %s" % (query, e))
+            products = None
+
+        now = time.time()
+
+        self.lock.acquire()
+        try:
+            waiting = self.inflight.pop(key, [])
+            current = self.current
+        finally:
+            self.lock.release()
+
+        if products is None:
+            return
+
+        for ks in waiting:
+            if ks is current:
+                ks.network_latency = now - ks.typed
+                self.on_results(ks.query, products, True)
+
+    def wait(self):
+        ''' block until pending and in-flight searches are done.  (mostly for tests) '''
+
+        while True:
+            self.lock.acquire()
+            try:
+                timer = self.timer
+                threads = self.threads
+                self.threads = []
+            finally:
+                self.lock.release()
+
+            if timer is not None:
+                timer.join()
+            for t in threads:
+                t.join()
+
+            self.lock.acquire()
+            try:
+                if not self.threads and (self.timer is None or not self.timer.is_alive()):
+                    return
+            finally:
+                self.lock.release()
+
+    def report(self):
+        ''' per-keystroke latency lines '''
+        return [str(ks) for ks in self.keystrokes]
@@ -0,0 +1,125 @@
+''' A small bounded thread pool for fanning blocking calls (mostly http requests) out in parallel. '''
+
+from collections import deque
+import itertools
+import logging
+logger = logging.getLogger("amazon")
+import Queue
+import threading
+
+
+class Result(object):
+    ''' outcome of a single call made by pmap.  either value is set, or error holds the exception that was raised. '''
+
+    def __init__(self, arg):
+        self.arg = arg          # the argument the call was made with
+        self.value = None
+        self.error = None
+
+    def ok(self):
+        return self.error is None
+
+    def get(self):
+        ''' return the value, or raise the error '''
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def __str__(self):
+        if self.error is not None:
+            return "%s: failed (%s)" % (self.arg, self.error)
+        return "%s: %s" % (self.arg, self.value)
+
+
+def pmap(func, args, max_workers=4):
+    ''' Call func(arg) for every arg on at most max_workers threads.
+
+        Returns a list of Result objects in the same order as args.  An exception raised by one call is caught and
+        recorded on its Result so it doesn't fail the rest of the batch.
+    '''
+
+    args = list(args)
+    results = [Result(arg) for arg in args]
+
+    work = Queue.Queue()
+    for i in xrange(len(args)):
+        work.put(i)
+
+    def worker():
+        while True:
+            try:
+                i = work.get_nowait()
+            except Queue.Empty:
+                return
+
+            result = results[i]
+            try:
+                result.value = func(result.arg)
+            except Exception, e:
+                logger.error("Call failed for %s: %s" % (result.arg, e))
+                result.error = e
+
+    num_workers = min(max_workers, len(args))
+    if num_workers <= 1:
+        # not worth a thread
+        worker()
+        return results
+
+    threads = []
+    for i in xrange(num_workers):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    for t in threads:
+        t.join()
+
+    return results
+
+
+class Prefetcher(object):
+    ''' Iterate over a Result for func(arg) for each arg, in order, keeping up to depth calls running ahead of the consumer.
+
+        Calls start as soon as the Prefetcher is made, so the first results can be on their way while the caller is
+        busy with something else.
+    '''
+
+    def __init__(self, func, args, depth=1):
+        self.func = func
+        self.args = iter(args)
+        self.pending = deque()
+
+        for arg in itertools.islice(self.args, max(depth, 1)):
+            self.start(arg)
+
+    def start(self, arg):
+        result = Result(arg)
+
+        def run():
+            try:
+                result.value = self.func(arg)
+            except Exception, e:
+                logger.error("Call failed for %s: %s" % (arg, e))
+                result.error = e
+
+        t = threading.Thread(target=run)
+        t.daemon = True
+        t.start()
+        self.pending.append((t, result))
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if not self.pending:
+            raise StopIteration()
+
+        (t, result) = self.pending.popleft()
+        t.join()
+
+        # keep the same number of calls running ahead:
+        for arg in itertools.islice(self.args, 1):
+            self.start(arg)
+
+        return result